@@ -0,0 +1,232 @@
+"""Benchmark the cleaning engine modes on a synthetic chip (see synth.py)
+and check them against the expected outcome.
+
+Each mode runs in a fresh interpreter so that its peak RSS is its own.
+Reported per mode: wall time, throughput, peak RSS, the time of every
+profiled stage, and whether the flagged lanes match the injected ones and
+the final fragment count matches the exact count projected from
+passed_filters.  The engine's reduction table must first match the one
+of the frozen baseline code (baseline.py) exactly.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "wf"))
+import baseline  # noqa: E402
+import clean  # noqa: E402
+from synth import Chip, generate  # noqa: E402
+
+# legacy is the in-memory clean_fragments; it downsamples but writes no
+# output, and only runs on chips of up to LEGACY_LIMIT fragments
+MODES = ["stream", "sort", "trust", "shard", "legacy"]
+LEGACY_LIMIT = 5_000_000
+
+
+def run_mode(mode: str, data_dir: str, out_dir: str, deviations: float):
+    """Clean the chip in data_dir with one engine mode; print a JSON
+    summary on stdout.
+    """
+
+    logging.disable(logging.INFO)
+    singlecell_path = os.path.join(data_dir, "singlecell.csv")
+    positions_path = os.path.join(data_dir, "positions.csv")
+    fragments_path = os.path.join(data_dir, "fragments.tsv.gz")
+    options = {
+        "stream": {},
+        "sort": {"preserve_order": False},
+        "trust": {"trust_passed_filters": True},
+        "shard": {"processes": max(2, os.cpu_count() or 1)},
+    }
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    if mode == "legacy":
+        cleaner = clean.Cleaner(deviations, seed=0)
+        profile = clean.StageProfile()
+        table = cleaner.reductions(singlecell_path, positions_path, profile)
+        metrics = dict(table.lanes)
+        with profile.stage("legacy"):
+            clean.clean_fragments(
+                fragments_path, table.reductions, 0, metrics
+            )
+        stages = profile.stages
+    else:
+        cleaner = clean.Cleaner(deviations, seed=0, **options[mode])
+        result = cleaner.clean(
+            "bench", singlecell_path, positions_path, fragments_path, out_dir
+        )
+        metrics = result.metrics
+        stages = result.profile.stages
+
+    print(
+        json.dumps(
+            {
+                "mode": mode,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() - cpu,
+                "peak_rss_bytes": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss
+                * 1024,
+                "metrics": metrics,
+                "stages": {
+                    name: stage["wall_s"] for name, stage in stages.items()
+                },
+            }
+        )
+    )
+
+
+def expected(chip: dict, data_dir: str, deviations: float) -> dict:
+    """Lanes the chip was built to flag and the exact final fragment
+    count of a run, from the reduction table of the baseline code
+    (baseline.py) and the exact passed_filters of the chip.  Raises if the
+    engine's reduction table or flagged lanes differ from the baseline's.
+    """
+
+    singlecell_path = os.path.join(data_dir, "singlecell.csv")
+    positions_path = os.path.join(data_dir, "positions.csv")
+    reductions, lanes = baseline.reductions(
+        singlecell_path, positions_path, deviations
+    )
+    table = clean.Cleaner(deviations).reductions(
+        singlecell_path, positions_path
+    )
+    if table.reductions != reductions:
+        raise AssertionError("Reduction table differs from the baseline's.")
+    if table.lanes != lanes:
+        raise AssertionError(
+            f"Flagged lanes {table.lanes} differ from the baseline's {lanes}."
+        )
+
+    singlecell = pd.read_csv(singlecell_path, usecols=[0, 2])
+    counts = dict(zip(singlecell.iloc[:, 0], singlecell.iloc[:, 1]))
+    removed = sum(
+        max(0, counts.get(barcode, 0) - math.floor(target))
+        for barcode, target in reductions.items()
+    )
+    return {
+        "row": ", ".join(str(i + 1) for i in sorted(chip["hot_rows"])),
+        "col": ", ".join(str(i + 1) for i in sorted(chip["hot_cols"])),
+        "down": "TRUE" if chip["hot_diagonals"] else "FALSE",
+        "og": chip["fragments"],
+        "final": chip["fragments"] - removed,
+    }
+
+
+def check(summary: dict, want: dict) -> str:
+    got = summary["metrics"]
+    problems = [
+        f"{key} {got.get(key)} != {value}"
+        for key, value in want.items()
+        if got.get(key) != value
+    ]
+    return "ok" if not problems else "; ".join(problems)
+
+
+def benchmark(
+    chip: Chip, modes: list, deviations: float, work_dir: str
+) -> list:
+    data_dir = os.path.join(work_dir, "chip")
+    description = generate(chip, data_dir)
+    want = expected(description, data_dir, deviations)
+    logging.disable(logging.INFO)
+
+    summaries = []
+    for mode in modes:
+        if mode == "legacy" and chip.fragments > LEGACY_LIMIT:
+            continue
+        out_dir = os.path.join(work_dir, mode)
+        completed = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--worker",
+                mode,
+                data_dir,
+                out_dir,
+                str(deviations),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        summary = json.loads(completed.stdout.splitlines()[-1])
+        summary["fragments_per_s"] = chip.fragments / summary["wall_s"]
+        summary["check"] = check(summary, want)
+        summaries.append(summary)
+
+    return summaries
+
+
+def report(summaries: list):
+    print(
+        f"{'mode':8s} {'wall s':>8s} {'frags/s':>10s} {'peak MB':>8s}  check"
+    )
+    for summary in summaries:
+        print(
+            f"{summary['mode']:8s} {summary['wall_s']:8.2f} "
+            f"{summary['fragments_per_s']:10.0f} "
+            f"{summary['peak_rss_bytes'] / 1024**2:8.0f}  "
+            f"{summary['check']}"
+        )
+    print()
+    for summary in summaries:
+        stages = ", ".join(
+            f"{name} {wall:.2f}" for name, wall in summary["stages"].items()
+        )
+        print(f"{summary['mode']:8s} {stages}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        mode, data_dir, out_dir, deviations = sys.argv[2:6]
+        run_mode(mode, data_dir, out_dir, float(deviations))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--fragments", type=int, default=1_000_000)
+    parser.add_argument("--on-fraction", type=float, default=0.8)
+    parser.add_argument("--hot-rows", type=int, nargs="*", default=[3, 17])
+    parser.add_argument("--hot-cols", type=int, nargs="*", default=[22])
+    parser.add_argument(
+        "--hot-diagonals", nargs="*", default=[], choices=["tl", "tr"]
+    )
+    parser.add_argument("--shuffled", action="store_true")
+    parser.add_argument("--deviations", type=float, default=1)
+    parser.add_argument("--modes", nargs="*", default=MODES, choices=MODES)
+    parser.add_argument("--work-dir", help="kept after the run if given")
+    parser.add_argument("--json", help="also write the summaries here")
+    args = parser.parse_args()
+
+    chip = Chip(
+        channels=args.channels,
+        fragments=args.fragments,
+        on_fraction=args.on_fraction,
+        hot_rows=args.hot_rows,
+        hot_cols=args.hot_cols,
+        hot_diagonals=args.hot_diagonals,
+        shuffled=args.shuffled,
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        summaries = benchmark(
+            chip, args.modes, args.deviations, args.work_dir or tmp
+        )
+    report(summaries)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=2)
+    if any(summary["check"] != "ok" for summary in summaries):
+        sys.exit(1)
@@ -0,0 +1,203 @@
+"""Synthetic DBiT chips for benchmarking: a positions file, a singlecell
+table and a fragments file, with hot rows, columns and diagonals injected.
+"""
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+from dataclasses import asdict, dataclass, field
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "wf"))
+from bgzf import BgzfWriter  # noqa: E402
+from clean import DEFAULT_CHUNKSIZE  # noqa: E402
+
+logging.basicConfig(
+    format="%(levelname)s - %(asctime)s - %(message)s", level=logging.INFO
+)
+
+CHROMOSOME_LENGTH = 200_000_000
+BASES = np.array(list("ACGT"))
+
+
+@dataclass
+class Chip:
+    """Layout of a synthetic chip; hot lanes are 0-based, "tl" and "tr"
+    name the two diagonals.
+    """
+
+    channels: int = 50
+    fragments: int = 1_000_000
+    on_fraction: float = 0.8
+    hot_rows: List[int] = field(default_factory=lambda: [3, 17])
+    hot_cols: List[int] = field(default_factory=lambda: [22])
+    hot_diagonals: List[str] = field(default_factory=list)
+    hot_factor: float = 4.0
+    off_factor: float = 0.2
+    chromosomes: int = 22
+    shuffled: bool = False
+    seed: int = 0
+
+
+def tixel_barcodes(channels: int, rng: np.random.Generator) -> np.ndarray:
+    """Distinct random 16-mers, one per tixel in row-major order."""
+
+    n = channels * channels
+    barcodes = np.unique(
+        ["".join(b) for b in rng.choice(BASES, (2 * n, 16))]
+    )
+    return rng.permutation(barcodes)[:n]
+
+
+def tixel_weights(chip: Chip, on: np.ndarray) -> np.ndarray:
+    """Relative fragment yield of every tixel: lognormal noise, raised in
+    hot lanes and lowered off tissue.
+    """
+
+    rng = np.random.default_rng(chip.seed + 1)
+    rows, cols = np.divmod(np.arange(chip.channels**2), chip.channels)
+    weights = rng.lognormal(0.0, 0.25, rows.size)
+    weights[np.isin(rows, chip.hot_rows)] *= chip.hot_factor
+    weights[np.isin(cols, chip.hot_cols)] *= chip.hot_factor
+    if "tl" in chip.hot_diagonals:
+        weights[rows == cols] *= chip.hot_factor
+    if "tr" in chip.hot_diagonals:
+        weights[rows + cols == chip.channels - 1] *= chip.hot_factor
+    weights[~on] *= chip.off_factor
+    return weights / weights.sum()
+
+
+def fragment_chunks(chip: Chip, weights: np.ndarray, chunksize: int):
+    """Yield (chromosome, start, tixel) arrays chunk by chunk; coordinate
+    sorted unless chip.shuffled.
+    """
+
+    rng = np.random.default_rng(chip.seed + 2)
+    per_chrom = rng.multinomial(
+        chip.fragments, np.full(chip.chromosomes, 1 / chip.chromosomes)
+    )
+    if chip.shuffled:
+        left = chip.fragments
+        while left > 0:
+            n = min(chunksize, left)
+            starts = rng.integers(0, CHROMOSOME_LENGTH, n)
+            chroms = rng.integers(1, chip.chromosomes + 1, n)
+            yield chroms, starts, rng.choice(weights.size, n, p=weights)
+            left -= n
+        return
+
+    for chrom, n_chrom in enumerate(per_chrom, start=1):
+        position = 0.0
+        gap = CHROMOSOME_LENGTH / max(n_chrom, 1)
+        for first in range(0, n_chrom, chunksize):
+            n = min(chunksize, n_chrom - first)
+            steps = np.cumsum(rng.exponential(gap, n)) + position
+            position = steps[-1]
+            starts = steps.astype(np.int64)
+            chroms = np.full(n, chrom)
+            yield chroms, starts, rng.choice(weights.size, n, p=weights)
+
+
+def generate(
+    chip: Chip, out_dir: str, chunksize: int = DEFAULT_CHUNKSIZE
+) -> dict:
+    """Write positions.csv, singlecell.csv and fragments.tsv.gz (BGZF) to
+    out_dir, and chip.json describing them.  passed_filters in the
+    singlecell table is the exact fragment count of each barcode.
+    Returns the chip description.
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(chip.seed)
+    n = chip.channels**2
+    barcodes = tixel_barcodes(chip.channels, rng)
+    on = rng.random(n) < chip.on_fraction
+    rows, cols = np.divmod(np.arange(n), chip.channels)
+
+    pd.DataFrame(
+        {
+            "barcodes": barcodes,
+            "on_off": on.astype(int),
+            "row": rows,
+            "col": cols,
+            "x": cols * 10,
+            "y": rows * 10,
+        }
+    ).to_csv(
+        os.path.join(out_dir, "positions.csv"), header=False, index=False
+    )
+
+    weights = tixel_weights(chip, on)
+    counts = np.zeros(n, dtype=np.int64)
+    suffixed = np.char.add(barcodes.astype(str), "-1")
+    fragments_path = os.path.join(out_dir, "fragments.tsv.gz")
+    logging.info(f"Writing {chip.fragments} fragments to {fragments_path}")
+    with BgzfWriter(fragments_path) as out:
+        for chroms, starts, tixels in fragment_chunks(
+            chip, weights, chunksize
+        ):
+            counts += np.bincount(tixels, minlength=n)
+            chunk = pd.DataFrame(
+                {
+                    "V1": np.char.add("chr", chroms.astype(str)),
+                    "V2": starts,
+                    "V3": starts + rng.integers(50, 500, starts.size),
+                    "barcodes": suffixed[tixels],
+                    "V4": rng.integers(1, 4, starts.size),
+                }
+            )
+            out.write(
+                chunk.to_csv(sep="\t", header=False, index=False).encode()
+            )
+
+    singlecell = pd.DataFrame(
+        {"barcodes": suffixed, "total": 2 * counts, "passed_filters": counts}
+    )
+    no_barcode = pd.DataFrame(
+        {"barcodes": ["NO_BARCODE"], "total": [0], "passed_filters": [0]}
+    )
+    pd.concat([no_barcode, singlecell]).to_csv(
+        os.path.join(out_dir, "singlecell.csv"), index=False
+    )
+
+    description = asdict(chip)
+    with open(os.path.join(out_dir, "chip.json"), "w") as f:
+        json.dump(description, f, indent=2)
+    return description
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("out_dir")
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--fragments", type=int, default=1_000_000)
+    parser.add_argument("--on-fraction", type=float, default=0.8)
+    parser.add_argument("--hot-rows", type=int, nargs="*", default=[3, 17])
+    parser.add_argument("--hot-cols", type=int, nargs="*", default=[22])
+    parser.add_argument(
+        "--hot-diagonals", nargs="*", default=[], choices=["tl", "tr"]
+    )
+    parser.add_argument("--hot-factor", type=float, default=4.0)
+    parser.add_argument("--shuffled", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(
+        Chip(
+            channels=args.channels,
+            fragments=args.fragments,
+            on_fraction=args.on_fraction,
+            hot_rows=args.hot_rows,
+            hot_cols=args.hot_cols,
+            hot_diagonals=args.hot_diagonals,
+            hot_factor=args.hot_factor,
+            shuffled=args.shuffled,
+            seed=args.seed,
+        ),
+        args.out_dir,
+    )
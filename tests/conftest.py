@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "wf"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from synth import Chip, generate  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def chip_dir(tmp_path_factory) -> str:
+    """Small synthetic chip with two hot rows and a hot column."""
+
+    out_dir = str(tmp_path_factory.mktemp("chip"))
+    generate(Chip(channels=30, fragments=60_000, seed=1), out_dir)
+    return out_dir
+
+
+@pytest.fixture(scope="session")
+def diagonal_chip_dir(tmp_path_factory) -> str:
+    """Small synthetic chip with a hot diagonal and shuffled fragments."""
+
+    out_dir = str(tmp_path_factory.mktemp("diagonal_chip"))
+    generate(
+        Chip(
+            channels=30,
+            fragments=60_000,
+            hot_rows=[],
+            hot_cols=[],
+            hot_diagonals=["tl"],
+            shuffled=True,
+            seed=2,
+        ),
+        out_dir,
+    )
+    return out_dir
+
+
+def chip_paths(chip_dir: str):
+    return [
+        os.path.join(chip_dir, name)
+        for name in ["singlecell.csv", "positions.csv", "fragments.tsv.gz"]
+    ]
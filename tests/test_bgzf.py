@@ -0,0 +1,64 @@
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bgzf
+import clean
+
+from conftest import chip_paths
+
+
+@pytest.fixture(scope="module")
+def cleaned(chip_dir, tmp_path_factory) -> str:
+    out_dir = str(tmp_path_factory.mktemp("cleaned"))
+    return clean.Cleaner(1, seed=0).clean("t", *chip_paths(chip_dir), out_dir)
+
+
+def read_tsv(path: str) -> pd.DataFrame:
+    return pd.read_csv(
+        path, sep="\t", header=None, names=clean.FRAGMENT_COLUMNS
+    )
+
+
+def test_bgzf_lines_match_gzip(cleaned):
+    with gzip.open(cleaned.fragments_file, "rb") as f:
+        content = f.read()
+    lines = b"".join(bgzf.read_bgzf_lines(cleaned.fragments_file, 1000, 2))
+
+    assert lines == content
+    assert bgzf.is_bgzf(cleaned.fragments_file)
+
+
+def test_tabix_fetch_matches_scan(cleaned):
+    pysam = pytest.importorskip("pysam")
+    fragments = read_tsv(cleaned.fragments_file)
+    rng = np.random.default_rng(0)
+
+    with pysam.TabixFile(cleaned.fragments_file) as tabix:
+        for chrom, rows in fragments.groupby("V1"):
+            assert len(list(tabix.fetch(chrom))) == len(rows)
+            for _ in range(10):
+                start = int(rng.integers(0, rows["V3"].max()))
+                end = start + int(rng.integers(1, 5_000_000))
+                want = rows[(rows["V2"] < end) & (rows["V3"] > start)]
+                got = [
+                    line.split("\t")
+                    for line in tabix.fetch(chrom, start, end)
+                ]
+                assert [int(x[1]) for x in got] == want["V2"].tolist()
+                assert [x[3] for x in got] == want["barcodes"].tolist()
+
+
+def test_barcode_index_counts(cleaned):
+    fragments = read_tsv(cleaned.fragments_file)
+    index = bgzf.read_barcode_index(f"{cleaned.fragments_file}.bci")
+    counts = np.bincount(
+        index["codes"],
+        weights=index["counts"],
+        minlength=len(index["barcodes"]),
+    )
+
+    got = dict(zip(index["barcodes"].tolist(), counts.astype(int).tolist()))
+    assert got == fragments["barcodes"].value_counts().to_dict()
@@ -0,0 +1,38 @@
+import os
+
+import cache
+
+from conftest import chip_paths
+
+
+def test_cache_key_is_stable(chip_dir, tmp_path):
+    paths = chip_paths(chip_dir)
+    key = cache.cache_key("t", *paths, 1)
+
+    copied = tmp_path / "fragments.tsv.gz"
+    copied.write_bytes(open(paths[2], "rb").read())
+    assert cache.cache_key("t", *paths[:2], str(copied), 1) == key
+    assert cache.cache_key("t", *paths, 2) != key
+    assert cache.cache_key("u", *paths, 1) != key
+
+    copied.write_bytes(b"changed")
+    assert cache.cache_key("t", *paths[:2], str(copied), 1) != key
+
+
+def test_local_cache_hit_and_miss(tmp_path):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    (out_dir / "cleaned_t_fragments.tsv.gz").write_bytes(b"fragments")
+    local = cache.LocalCache(str(tmp_path / "cache"))
+
+    assert local.get("key") is None
+    assert local.put("key", str(out_dir)) == local.get("key")
+    assert local.get("other") is None
+
+    restored = tmp_path / "restored"
+    assert local.restore("key", str(restored))
+    assert not local.restore("other", str(tmp_path / "missing"))
+    assert os.listdir(restored) == ["cleaned_t_fragments.tsv.gz"]
+    assert (restored / "cleaned_t_fragments.tsv.gz").read_bytes() == (
+        b"fragments"
+    )
@@ -0,0 +1,53 @@
+import math
+
+import pandas as pd
+
+import clean
+
+from conftest import chip_paths
+
+
+def barcode_counts(path: str) -> dict:
+    fragments = pd.read_csv(
+        path, sep="\t", header=None, names=clean.FRAGMENT_COLUMNS
+    )
+    return fragments["barcodes"].value_counts().to_dict()
+
+
+def undercounted_table(chip_dir: str):
+    """Reduction table whose passed_filters of one outlier barcode is set
+    to its target, so the barcode looks like it needs no downsampling.
+    """
+
+    singlecell_path, positions_path, fragments_path = chip_paths(chip_dir)
+    table = clean.Cleaner(1).reductions(singlecell_path, positions_path)
+    counts = barcode_counts(fragments_path)
+    barcode = max(
+        table.reductions,
+        key=lambda b: counts.get(b, 0) - table.reductions[b],
+    )
+    target = math.floor(table.reductions[barcode])
+    assert counts[barcode] > target
+    table.barcode_counts = {**table.barcode_counts, barcode: target}
+    return table, barcode, target
+
+
+def test_sampler_tracks_barcodes_kept_whole():
+    sampler = clean.SelectionSampler({"a": 2, "b": 10}, {"a": 5, "b": 4})
+    sampler.keep(pd.Series(["a"] * 3 + ["b"] * 10))
+
+    assert not sampler.exact_counts()
+
+
+def test_undercount_is_cleaned_again(chip_dir, tmp_path):
+    table, barcode, target = undercounted_table(chip_dir)
+    fragments_path = chip_paths(chip_dir)[2]
+    cleaner = clean.Cleaner(1, seed=0, trust_passed_filters=True)
+
+    result = cleaner.apply("t", table, fragments_path, str(tmp_path / "one"))
+    (many,) = cleaner.apply_many(
+        "t", [table], fragments_path, str(tmp_path / "many")
+    )
+
+    assert barcode_counts(result.fragments_file)[barcode] == target
+    assert barcode_counts(many.fragments_file)[barcode] == target
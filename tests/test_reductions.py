@@ -0,0 +1,68 @@
+import pickle
+
+import pytest
+
+import baseline
+import clean
+
+from conftest import chip_paths
+
+
+@pytest.mark.parametrize("deviations", [1, 2])
+def test_reductions_match_baseline(chip_dir, deviations):
+    singlecell_path, positions_path, _ = chip_paths(chip_dir)
+    reductions, lanes = baseline.reductions(
+        singlecell_path, positions_path, deviations
+    )
+    table = clean.Cleaner(deviations).reductions(
+        singlecell_path, positions_path
+    )
+
+    assert table.reductions == reductions
+    assert table.lanes == lanes
+
+
+def test_diagonal_reductions_match_baseline(diagonal_chip_dir):
+    singlecell_path, positions_path, _ = chip_paths(diagonal_chip_dir)
+    reductions, lanes = baseline.reductions(singlecell_path, positions_path, 1)
+    table = clean.Cleaner(1).reductions(singlecell_path, positions_path)
+
+    assert lanes["down"] == "TRUE"
+    assert table.reductions == reductions
+    assert table.lanes == lanes
+
+
+def test_grid_cache_shared_between_cleaners(chip_dir, monkeypatch):
+    singlecell_path, positions_path, _ = chip_paths(chip_dir)
+    grids = clean.GridCache()
+    grids.get(positions_path)
+    grids = pickle.loads(pickle.dumps(grids))
+
+    def parse(position_path):
+        raise AssertionError("positions file parsed again")
+
+    monkeypatch.setattr(clean.ChipGrid, "from_positions", parse)
+    tables = [
+        clean.Cleaner(deviations, grids=grids).reductions(
+            singlecell_path, positions_path
+        )
+        for deviations in [1, 2]
+    ]
+
+    assert len(grids.grids) == 1
+    assert [table.deviations for table in tables] == [1, 2]
+
+
+def test_sweep_output_dirs(chip_dir, tmp_path):
+    singlecell_path, positions_path, fragments_path = chip_paths(chip_dir)
+    clean.sweep_deviations(
+        "t",
+        singlecell_path,
+        positions_path,
+        [1.0, 1.5],
+        str(tmp_path),
+        fragments_path,
+    )
+
+    for name in ["deviations_1", "deviations_1.5"]:
+        assert (tmp_path / name / "cleaned_t_fragments.tsv.gz").exists()
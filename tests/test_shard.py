@@ -0,0 +1,38 @@
+import math
+
+import pandas as pd
+
+import clean
+
+from conftest import chip_paths
+
+
+def barcode_counts(path: str) -> dict:
+    fragments = pd.read_csv(
+        path, sep="\t", header=None, names=clean.FRAGMENT_COLUMNS
+    )
+    return fragments["barcodes"].value_counts().to_dict()
+
+
+def test_sharded_counts_match_streamed(chip_dir, tmp_path):
+    paths = chip_paths(chip_dir)
+    streamed = clean.Cleaner(1, seed=0).clean(
+        "t", *paths, str(tmp_path / "stream")
+    )
+    sharded = clean.Cleaner(1, seed=0, processes=2).clean(
+        "t", *paths, str(tmp_path / "shard")
+    )
+
+    original = barcode_counts(paths[2])
+    want = {
+        barcode: min(n, math.floor(streamed.reductions[barcode]))
+        if barcode in streamed.reductions
+        else n
+        for barcode, n in original.items()
+    }
+    want = {barcode: n for barcode, n in want.items() if n > 0}
+    for stage in ["shard", "count", "read", "downsample", "compress"]:
+        assert stage in sharded.profile.stages
+    assert barcode_counts(streamed.fragments_file) == want
+    assert barcode_counts(sharded.fragments_file) == want
+    assert sharded.metrics["final"] == streamed.metrics["final"]
@@ -0,0 +1,97 @@
+import collections
+import math
+
+import pandas as pd
+
+import clean
+
+from conftest import chip_paths
+
+
+def read_tsv(path: str) -> pd.DataFrame:
+    return pd.read_csv(
+        path, sep="\t", header=None, names=clean.FRAGMENT_COLUMNS
+    )
+
+
+def expected_counts(original: pd.DataFrame, reductions: dict) -> dict:
+    counts = {
+        barcode: min(n, math.floor(reductions[barcode]))
+        if barcode in reductions
+        else n
+        for barcode, n in original["barcodes"].value_counts().items()
+    }
+    return {barcode: n for barcode, n in counts.items() if n > 0}
+
+
+def lines(fragments: pd.DataFrame) -> collections.Counter:
+    return collections.Counter(
+        map(tuple, fragments.astype(str).values.tolist())
+    )
+
+
+def test_update_round_trip(chip_dir, tmp_path):
+    singlecell_path, positions_path, fragments_path = chip_paths(chip_dir)
+    cleaner = clean.Cleaner(1, seed=0)
+    first = cleaner.clean(
+        "t",
+        singlecell_path,
+        positions_path,
+        fragments_path,
+        str(tmp_path / "first"),
+    )
+    original = read_tsv(fragments_path)
+
+    # Lower some targets, raise others, drop one and add a new barcode
+    table = clean.ReductionTable.read(
+        str(tmp_path / "first" / "t_reductions.json")
+    )
+    old = dict(table.reductions)
+    barcodes = sorted(old)
+    new = dict(old)
+    for barcode in barcodes[:5]:
+        new[barcode] = old[barcode] / 2
+    for barcode in barcodes[5:10]:
+        new[barcode] = old[barcode] * 2
+    del new[barcodes[10]]
+    extra = next(b for b in original["barcodes"] if b not in old)
+    new[extra] = 1
+    table.reductions = new
+
+    updated = cleaner.update(
+        "t",
+        table,
+        str(tmp_path / "first"),
+        fragments_path,
+        str(tmp_path / "updated"),
+    )
+    assert "rewrite" in updated.profile.stages
+    fragments = read_tsv(updated.fragments_file)
+    counts = fragments["barcodes"].value_counts().to_dict()
+    assert counts == expected_counts(original, new)
+    assert not lines(fragments) - lines(original)
+    assert updated.metrics["final"] == len(fragments)
+
+    # Barcodes whose target did not change keep the same fragments
+    changed = {b for b in set(old) | set(new) if old.get(b) != new.get(b)}
+    before = read_tsv(first.fragments_file)
+    assert lines(before[~before["barcodes"].isin(changed)]) == lines(
+        fragments[~fragments["barcodes"].isin(changed)]
+    )
+
+    # And back
+    table.reductions = old
+    restored = cleaner.update(
+        "t",
+        table,
+        str(tmp_path / "updated"),
+        fragments_path,
+        str(tmp_path / "restored"),
+    )
+    fragments = read_tsv(restored.fragments_file)
+    counts = fragments["barcodes"].value_counts().to_dict()
+    assert counts == expected_counts(original, old)
+    assert not lines(fragments) - lines(original)
+    chroms = fragments["V1"].to_numpy()
+    same = chroms[1:] == chroms[:-1]
+    assert (fragments["V2"].diff().to_numpy()[1:][same] >= 0).all()
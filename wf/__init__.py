@@ -1,7 +1,14 @@
 """Latch workflow for normalizing hot rows and columns in spatial ATAC-seq data
 """
 
-from wf.cleaning_task import cleaning_task, Sample, CleaningOutput
+from wf.batch_task import (
+    batch_samples_task,
+    flatten_outputs_task,
+    large_cleaning_task,
+    medium_cleaning_task,
+    small_cleaning_task,
+)
+from wf.cleaning_task import Sample, CleaningOutput
 from wf.upload_registry_task import upload_registry_task
 
 from latch import workflow, map_task
@@ -37,6 +44,13 @@ metadata = LatchMetadata(
                 workflow finishes. (e.g. 761)",
             placeholder="761",
         ),
+        "batch_mb": LatchParameter(
+            display_name="Batch Size (MB)",
+            description="Samples are packed into containers holding up to \
+                this many MB of fragments files and cleaned side by side; \
+                larger samples run in a container of their own.",
+            hidden=True,
+        ),
     },
     tags=[],
 )
@@ -46,6 +60,7 @@ metadata = LatchMetadata(
 def clean_workflow(
     samples: List[Sample],
     table_id: str = "761",
+    batch_mb: int = 2048,
 ) -> List[CleaningOutput]:
     """Workflow for remediating microfludic artifacts in spatial ATAC-seq data
 
@@ -106,10 +121,24 @@ def clean_workflow(
     * standard deviations: Number of standard deviations (1 or 2) above with
     row/column fragment counts are considered outliers.
 
+    * degree (optional, default 1): Radius of the neighborhood whose average
+    fragment count tixels of outlier rows/columns are reduced to; 1 uses the
+    eight adjacent tixels, k the (2k+1) x (2k+1) square around the tixel.
+
+    * parquet (optional, default false): Also write the cleaned fragments as
+    a Parquet file, registered in the Registry table as
+    cleaned_parquet_file.
+
     * Registry Table ID: Identifier of the latch.bio
     [registry](https://docs.latch.bio/registry/overview.html) table where run
     metadata will be recorded.
 
+    * Batch Size (MB): Samples are packed into containers holding up to this
+    many MB of fragments files, so that small samples share one container;
+    samples above it run on their own (default 2048).  Each sample runs on a
+    small, medium or large machine according to the memory its file sizes
+    call for.
+
 
     ## Running the workflow
 
@@ -151,6 +180,25 @@ def clean_workflow(
     * cleaned_[run_id]_fragments.tsv.gz: A fragments file with outlier
     rows/columns downsampled to local averages.
 
+    * cleaned_[run_id]_fragments.tsv.gz.tbi: A tabix index of the cleaned
+    fragments file.
+
+    * cleaned_[run_id]_fragments.tsv.gz.bci: A barcode index of the cleaned
+    fragments file (fragments of each barcode per region of BGZF blocks),
+    used to update the file in place when the reduction table changes.
+
+    * [run_id]_reductions.json: The reduction table (target fragment count of
+    each downsampled tixel), the row/column statistics and the flagged tixels
+    of the run.
+
+    * [run_id]_profile.json: Wall time, CPU time, peak memory and rows/bytes
+    processed for each stage of the cleaning.
+
+    * cleaned_[run_id]_fragments.parquet (with parquet): The cleaned
+    fragments as Parquet, with columns chrom, start, end, barcode and count;
+    chromosomes and barcodes are dictionary encoded and every row group
+    holds a single chromosome.
+
     * [run_id]_cleaning_metrics.csv: A comma-separated table containing the
     following summary statistics:
         * Columns downsampled: Indices (1-based) of columns identified as
@@ -188,7 +236,15 @@ def clean_workflow(
     [Discord](https://discord.com/channels/1004748539827597413/1005222888384770108).
     """
     
-    cleaned_outputs = map_task(cleaning_task)(sample=samples)
+    plan = batch_samples_task(samples=samples, batch_mb=batch_mb)
+    cleaned_outputs = flatten_outputs_task(
+        small_batches=plan.small,
+        medium_batches=plan.medium,
+        large_batches=plan.large,
+        small=map_task(small_cleaning_task)(batch=plan.small),
+        medium=map_task(medium_cleaning_task)(batch=plan.medium),
+        large=map_task(large_cleaning_task)(batch=plan.large),
+    )
 
     upload_registry_task(cleaned_outputs=cleaned_outputs, table_id=table_id)
 
@@ -212,7 +268,7 @@ LaunchPlan(
                 fragments_file=LatchFile(
                     "latch:///chromap_outputs/demo/chromap_output/fragments.tsv.gz"
                 ),
-                deviations=2,
+                deviations=2.0,
             )
         ]
     },
@@ -233,7 +289,7 @@ if __name__ == "__main__":
                 fragments_file=LatchFile(
                     "latch:///atac_outs/demo/outs/demo_fragments.tsv.gz"
                 ),
-                deviations=2,
+                deviations=2.0,
             )
         ],
         table_id="761",
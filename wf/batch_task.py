@@ -0,0 +1,267 @@
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, NamedTuple
+
+from latch import large_task, medium_task, small_task
+from latch.ldata.path import LPath
+
+from wf.cache import LatchCache
+from wf.clean import (
+    GridCache,
+    clean_sample,
+    estimate_peak_memory,
+    file_digest,
+)
+from wf.cleaning_task import (
+    CleaningOutput,
+    Sample,
+    cached_output,
+    cleaning_output,
+    local_output_dir,
+    sample_cache_key,
+)
+
+logging.basicConfig(
+    format="%(levelname)s - %(asctime)s - %(message)s", level=logging.INFO
+)
+
+DEFAULT_BATCH_MB = 2048
+MAX_BATCH_SAMPLES = 16
+
+# Memory of the latch task classes, smallest first; a sample goes to the
+# smallest class whose memory covers its estimated peak with headroom
+TASK_MEMORY = {
+    "small": 4 * 1024**3,
+    "medium": 128 * 1024**3,
+    "large": 192 * 1024**3,
+}
+MEMORY_HEADROOM = 0.75
+
+
+@dataclass
+class SampleBatch:
+    samples: List[Sample]
+    # position of each sample in the samplesheet
+    indices: List[int]
+
+
+class BatchPlan(NamedTuple):
+    small: List[SampleBatch]
+    medium: List[SampleBatch]
+    large: List[SampleBatch]
+
+
+def remote_size(sample: Sample, file_attr: str) -> int:
+    """Size in bytes of one of a sample's remote files; unknown sizes are
+    reported as -1.
+    """
+
+    try:
+        return LPath(getattr(sample, file_attr).remote_path).size()
+    except Exception as e:
+        logging.warning(f"No size for {sample.run_id} {file_attr}: {e}")
+        return -1
+
+
+def task_class(fragments_bytes: int, singlecell_bytes: int) -> str:
+    """Smallest task class able to clean a sample; samples of unknown
+    size go to the largest.
+    """
+
+    if fragments_bytes < 0 or singlecell_bytes < 0:
+        return "large"
+    needed = estimate_peak_memory(fragments_bytes, singlecell_bytes)
+    for name, memory in TASK_MEMORY.items():
+        if needed <= MEMORY_HEADROOM * memory:
+            return name
+    return "large"
+
+
+def pool_size(samples: List[Sample]) -> int:
+    """Number of samples to clean at once: bounded by the cores and by the
+    memory of the container over the largest estimated peak.
+    """
+
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    peak = max(
+        estimate_peak_memory(
+            os.path.getsize(sample.fragments_file.local_path),
+            os.path.getsize(sample.singlecell_file.local_path),
+        )
+        for sample in samples
+    )
+    by_memory = max(1, int(MEMORY_HEADROOM * memory // peak))
+
+    return min(len(samples), os.cpu_count() or 1, by_memory)
+
+
+def pack_batches(
+    sizes: List[int], max_bytes: int, max_samples: int = MAX_BATCH_SAMPLES
+) -> List[List[int]]:
+    """Group sample indices first-fit decreasing by size so that each
+    batch holds at most max_bytes of fragments and max_samples samples;
+    samples above max_bytes or of unknown size (< 0) get a batch of their
+    own.  Batches keep input order within themselves.
+    """
+
+    batches, loads = [], []
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i])
+    for i in order:
+        size = sizes[i]
+        if size < 0 or size >= max_bytes:
+            batches.append([i])
+            loads.append(max_bytes)
+            continue
+        for b, load in enumerate(loads):
+            if load + size <= max_bytes and len(batches[b]) < max_samples:
+                batches[b].append(i)
+                loads[b] += size
+                break
+        else:
+            batches.append([i])
+            loads.append(size)
+
+    return sorted(sorted(batch) for batch in batches)
+
+
+@small_task
+def batch_samples_task(
+    samples: List[Sample], batch_mb: int = DEFAULT_BATCH_MB
+) -> BatchPlan:
+    """Size every sample from its remote files, then pack the samples of
+    each task class into batches.
+    """
+
+    classes = {name: [] for name in TASK_MEMORY}
+    for index, sample in enumerate(samples):
+        fragments_bytes = remote_size(sample, "fragments_file")
+        singlecell_bytes = remote_size(sample, "singlecell_file")
+        name = task_class(fragments_bytes, singlecell_bytes)
+        logging.info(f"{sample.run_id}: {fragments_bytes} bytes, {name} task")
+        classes[name].append((index, sample, fragments_bytes))
+
+    plan = {}
+    for name, sized in classes.items():
+        sizes = [size for _, _, size in sized]
+        plan[name] = [
+            SampleBatch(
+                samples=[sized[i][1] for i in batch],
+                indices=[sized[i][0] for i in batch],
+            )
+            for batch in pack_batches(sizes, batch_mb * 1024**2)
+        ]
+        logging.info(f"{name} tasks: {len(plan[name])} batches")
+
+    return BatchPlan(**plan)
+
+
+def clean_batch(
+    batch: SampleBatch, shard: bool = False
+) -> List[CleaningOutput]:
+    """Clean every sample of a batch in one container, on a local pool of
+    worker processes; samples cleaned before with the same inputs reuse
+    their outputs.  With shard, the cores left over by the pool shard the
+    fragments pass of each sample (Cleaner processes).  Returns one
+    CleaningOutput per sample, in order.
+
+    Samples usually share a positions file: each distinct one (by
+    digest) is parsed once here and its grid handed to the workers.
+    """
+
+    keys = [sample_cache_key(sample) for sample in batch.samples]
+    outputs = [
+        cached_output(sample, key) for sample, key in zip(batch.samples, keys)
+    ]
+    todo = [i for i, output in enumerate(outputs) if output is None]
+    if len(todo) == 0:
+        return outputs
+
+    samples = [batch.samples[i] for i in todo]
+    workers = pool_size(samples)
+    processes = max(1, (os.cpu_count() or 1) // workers) if shard else 1
+    logging.info(
+        f"cleaning {len(samples)} samples on {workers} workers, "
+        f"{processes} processes each..."
+    )
+
+    digests = [
+        file_digest(sample.positions_file.local_path) for sample in samples
+    ]
+    grids = {}
+    for sample, digest in zip(samples, digests):
+        if digest not in grids:
+            grids[digest] = GridCache(size=1)
+            grids[digest].get(sample.positions_file.local_path)
+    logging.info(f"{len(grids)} distinct positions files")
+
+    # workers are reused; each run's profile resets the peak RSS, so it
+    # is that sample's own
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(
+                clean_sample,
+                sample.run_id,
+                sample.singlecell_file.local_path,
+                sample.positions_file.local_path,
+                sample.fragments_file.local_path,
+                sample.deviations,
+                out_dir=local_output_dir(sample),
+                degree=sample.degree,
+                parquet=sample.parquet,
+                trust_passed_filters=True,
+                processes=processes,
+                grids=grids[digest],
+            )
+            for sample, digest in zip(samples, digests)
+        ]
+        for future in futures:
+            future.result()
+
+    cache = LatchCache()
+    for i, sample in zip(todo, samples):
+        cache.put(keys[i], local_output_dir(sample))
+        outputs[i] = cleaning_output(sample)
+
+    return outputs
+
+
+@small_task
+def small_cleaning_task(batch: SampleBatch) -> List[CleaningOutput]:
+    return clean_batch(batch)
+
+
+@medium_task
+def medium_cleaning_task(batch: SampleBatch) -> List[CleaningOutput]:
+    return clean_batch(batch)
+
+
+@large_task
+def large_cleaning_task(batch: SampleBatch) -> List[CleaningOutput]:
+    return clean_batch(batch, shard=True)
+
+
+@small_task
+def flatten_outputs_task(
+    small_batches: List[SampleBatch],
+    medium_batches: List[SampleBatch],
+    large_batches: List[SampleBatch],
+    small: List[List[CleaningOutput]],
+    medium: List[List[CleaningOutput]],
+    large: List[List[CleaningOutput]],
+) -> List[CleaningOutput]:
+    """Outputs of every batch, back in samplesheet order."""
+
+    indexed = [
+        (index, output)
+        for batches, batched_outputs in [
+            (small_batches, small),
+            (medium_batches, medium),
+            (large_batches, large),
+        ]
+        for batch, outputs in zip(batches, batched_outputs)
+        for index, output in zip(batch.indices, outputs)
+    ]
+    return [output for _, output in sorted(indexed, key=lambda x: x[0])]
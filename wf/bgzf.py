@@ -0,0 +1,776 @@
+"""BGZF (blocked gzip) files and their indexes: a parallel BGZF writer
+and reader, the tabix index (.tbi) and the barcode index (.bci) written
+next to the cleaned fragments file.
+"""
+
+import collections
+import numpy as np
+import os
+import pandas as pd
+import struct
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+# Uncompressed bytes per BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+# Tabix binning scheme (min_shift 14, depth 5) and the 'bed' preset
+TABIX_MIN_SHIFT = 14
+TABIX_LEVELS = [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]
+TABIX_META_BIN = 37450
+TABIX_BED_FORMAT = 0x10000
+# Blocks per region of the barcode index written next to the tabix index
+BARCODE_INDEX_BLOCKS = 64
+
+
+def bgzf_block(data: bytes, level: int = 6) -> bytes:
+    """Compress at most BGZF_BLOCK_SIZE bytes into one BGZF block."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack(
+        "<4BI2BH2BHH",
+        31, 139, 8, 4,  # gzip magic, deflate, FEXTRA
+        0,  # mtime
+        0, 255,  # xfl, os
+        6,  # xlen
+        66, 67, 2,  # 'BC' subfield
+        len(compressed) + 25,  # total block size - 1
+    )
+    footer = struct.pack("<2I", zlib.crc32(data), len(data))
+
+    return header + compressed + footer
+
+
+def line_starts(data: bytes, base: int) -> np.ndarray:
+    """Uncompressed offsets of the lines of data, written at base."""
+
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+    return np.concatenate([[0], line_ends[:-1] + 1]).astype(np.int64) + base
+
+
+def reg2bin(begs: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Vectorized tabix/UCSC bin of 0-based, end-exclusive intervals."""
+
+    last = np.maximum(ends, begs + 1) - 1
+    bins = np.zeros(begs.shape, dtype=np.int64)
+    for shift, offset in TABIX_LEVELS:
+        same = (begs >> shift) == (last >> shift)
+        bins = np.where(same, offset + (begs >> shift), bins)
+    return bins
+
+
+class TabixReference:
+    """Index of one chromosome; offsets are uncompressed file offsets
+    until the index is written.
+    """
+
+    def __init__(self):
+        self.bins = {}
+        self.linear = {}
+        self.n_records = 0
+        self.first = None
+        self.last = 0
+
+
+class TabixIndex:
+    """Tabix (.tbi) index built while a BGZF file is being written.
+
+    Records are indexed by their uncompressed offsets, which are mapped
+    to virtual offsets once the offsets of every block are known.
+    """
+
+    def __init__(self):
+        self.refs = {}
+
+    def extend(self, other: "TabixIndex", shift: int):
+        """Append the index of a file written directly after this one;
+        shift is the uncompressed size of everything before it.
+        """
+
+        for name, ref in other.refs.items():
+            if name not in self.refs:
+                self.refs[name] = TabixReference()
+            target = self.refs[name]
+            for b, chunks in ref.bins.items():
+                target.bins.setdefault(b, []).extend(
+                    [u_start + shift, u_end + shift]
+                    for u_start, u_end in chunks
+                )
+            for w, u_start in ref.linear.items():
+                target.linear[w] = min(
+                    target.linear.get(w, u_start + shift), u_start + shift
+                )
+            if target.first is None:
+                target.first = ref.first + shift
+            target.last = ref.last + shift
+            target.n_records += ref.n_records
+
+    def add(
+        self,
+        chroms: np.ndarray,
+        begs: np.ndarray,
+        ends: np.ndarray,
+        base: int,
+        data: bytes,
+    ):
+        """Index the records of data, one per line, that will be written
+        at uncompressed offset base.
+        """
+
+        record_starts = line_starts(data, base)
+        line_ends = np.append(record_starts[1:], base + len(data))
+        begs = begs.astype(np.int64)
+        ends = ends.astype(np.int64)
+        bins = reg2bin(begs, ends)
+        first_windows = begs >> TABIX_MIN_SHIFT
+        last_windows = (np.maximum(ends, begs + 1) - 1) >> TABIX_MIN_SHIFT
+
+        chrom_change = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        chrom_starts = np.concatenate([[0], chrom_change])
+        chrom_ends = np.concatenate([chrom_change, [len(chroms)]])
+        for c_start, c_end in zip(chrom_starts, chrom_ends):
+            ref = self.refs.setdefault(chroms[c_start], TabixReference())
+            if ref.first is None:
+                ref.first = int(record_starts[c_start])
+            ref.last = int(line_ends[c_end - 1])
+            ref.n_records += int(c_end - c_start)
+            starts = record_starts[c_start:c_end]
+            seg_ends = line_ends[c_start:c_end]
+
+            # Chunks: runs of records in the same bin, merged with the
+            # bin's previous chunk when they meet in the same (nominal)
+            # block
+            seg_bins = bins[c_start:c_end]
+            change = np.flatnonzero(seg_bins[1:] != seg_bins[:-1]) + 1
+            run_starts = np.concatenate([[0], change])
+            run_ends = np.concatenate([change, [len(seg_bins)]]) - 1
+            for b, u_start, u_end in zip(
+                seg_bins[run_starts].tolist(),
+                starts[run_starts].tolist(),
+                seg_ends[run_ends].tolist(),
+            ):
+                chunks = ref.bins.setdefault(b, [])
+                if (
+                    chunks
+                    and chunks[-1][1] // BGZF_BLOCK_SIZE
+                    == u_start // BGZF_BLOCK_SIZE
+                ):
+                    chunks[-1][1] = u_end
+                else:
+                    chunks.append([u_start, u_end])
+
+            # Linear index: smallest offset of a record overlapping each
+            # 16kb window
+            seg_first = first_windows[c_start:c_end]
+            seg_last = last_windows[c_start:c_end]
+            windows, first = np.unique(seg_first, return_index=True)
+            for w, u_start in zip(windows.tolist(), starts[first].tolist()):
+                ref.linear[w] = min(ref.linear.get(w, u_start), u_start)
+            for i in np.flatnonzero(seg_last > seg_first):
+                u_start = int(starts[i])
+                for w in range(int(seg_first[i]) + 1, int(seg_last[i]) + 1):
+                    ref.linear[w] = min(ref.linear.get(w, u_start), u_start)
+
+    def write(self, path: str, blocks: List[Tuple[int, int]]):
+        """Write the index to path; blocks are the (uncompressed,
+        compressed) start offsets of every block of the indexed file,
+        followed by the offsets of its end.
+        """
+
+        u_starts = np.array([u for u, _ in blocks], dtype=np.int64)
+        c_starts = np.array([c for _, c in blocks], dtype=np.int64)
+
+        def voffset(u: np.ndarray) -> np.ndarray:
+            u = np.asarray(u, dtype=np.int64)
+            block = np.searchsorted(u_starts, u, side="right") - 1
+            return (c_starts[block] << 16) | (u - u_starts[block])
+
+        names = b"".join(name.encode() + b"\0" for name in self.refs)
+        payload = bytearray(b"TBI\1")
+        payload += struct.pack(
+            "<8i",
+            len(self.refs),
+            TABIX_BED_FORMAT,
+            1,  # sequence column
+            2,  # start column
+            3,  # end column
+            ord("#"),
+            0,  # lines to skip
+            len(names),
+        )
+        payload += names
+
+        for ref in self.refs.values():
+            payload += struct.pack("<i", len(ref.bins) + 1)
+            bins = sorted(ref.bins)
+            chunks = voffset(
+                [u for b in bins for chunk in ref.bins[b] for u in chunk]
+            ).astype("<u8")
+            pos = 0
+            for b in bins:
+                n_chunks = len(ref.bins[b])
+                payload += struct.pack("<Ii", b, n_chunks)
+                payload += chunks[pos : pos + 2 * n_chunks].tobytes()
+                pos += 2 * n_chunks
+            payload += struct.pack(
+                "<IiQQQQ",
+                TABIX_META_BIN,
+                2,
+                *voffset([ref.first, ref.last]).tolist(),
+                ref.n_records,
+                0,
+            )
+
+            n_windows = max(ref.linear) + 1
+            linear = []
+            fill = ref.linear[min(ref.linear)]
+            for w in range(n_windows):
+                fill = ref.linear.get(w, fill)
+                linear.append(fill)
+            payload += struct.pack("<i", n_windows)
+            payload += voffset(linear).astype("<u8").tobytes()
+
+        payload += struct.pack("<Q", 0)  # records without coordinates
+        with BgzfWriter(path, threads=1) as out:
+            out.write(bytes(payload))
+
+    @classmethod
+    def read(cls, path: str, blocks: List[Tuple[int, int]]) -> "TabixIndex":
+        """Read an index written by write, mapping its virtual offsets
+        back to uncompressed offsets with the blocks of the indexed file.
+        """
+
+        with open(path, "rb") as handle:
+            payload = b"".join(
+                inflate_bgzf_block(block) for block in read_bgzf_blocks(handle)
+            )
+        u_starts = np.array([u for u, _ in blocks], dtype=np.int64)
+        c_starts = np.array([c for _, c in blocks], dtype=np.int64)
+
+        def offset(voffsets: np.ndarray) -> np.ndarray:
+            voffsets = np.asarray(voffsets, dtype=np.int64)
+            block = np.searchsorted(c_starts, voffsets >> 16)
+            return u_starts[block] + (voffsets & 0xFFFF)
+
+        n_refs = struct.unpack_from("<i", payload, 4)[0]
+        names_size = struct.unpack_from("<i", payload, 32)[0]
+        names = payload[36 : 36 + names_size].split(b"\0")[:n_refs]
+        pos = 36 + names_size
+
+        index = cls()
+        for name in names:
+            ref = index.refs.setdefault(name.decode(), TabixReference())
+            (n_bins,) = struct.unpack_from("<i", payload, pos)
+            pos += 4
+            bins = []
+            sizes = []
+            chunks = []
+            for _ in range(n_bins):
+                b, n_chunks = struct.unpack_from("<Ii", payload, pos)
+                pos += 8
+                values = np.frombuffer(payload, "<u8", 2 * n_chunks, pos)
+                pos += 16 * n_chunks
+                if b == TABIX_META_BIN:
+                    ref.first, ref.last = offset(values[:2]).tolist()
+                    ref.n_records = int(values[2])
+                    continue
+                bins.append(b)
+                sizes.append(n_chunks)
+                chunks.append(values)
+            if chunks:
+                u_chunks = offset(np.concatenate(chunks)).reshape(-1, 2)
+                u_chunks = u_chunks.tolist()
+                ends = np.cumsum(sizes).tolist()
+                ref.bins = {
+                    b: u_chunks[end - size : end]
+                    for b, size, end in zip(bins, sizes, ends)
+                }
+            (n_windows,) = struct.unpack_from("<i", payload, pos)
+            pos += 4
+            linear = np.frombuffer(payload, "<u8", n_windows, pos)
+            pos += 8 * n_windows
+            ref.linear = dict(enumerate(offset(linear).tolist()))
+
+        return index
+
+
+class BarcodeBlockIndex:
+    """Index of the barcodes of a BGZF fragments file, built while it is
+    being written, for rewriting only the blocks holding fragments of
+    given barcodes (update_fragments).  Every line belongs to the block
+    it starts in; the index holds the fragment count of each barcode in
+    every region of BARCODE_INDEX_BLOCKS blocks, and the chromosome and
+    start of the first line of every block.
+    """
+
+    def __init__(self):
+        self.barcodes = {}  # barcode -> code
+        self.chroms = {}  # chromosome -> code, in file order
+        self.entries = []  # (region, barcode code, count) arrays
+        self.first = {}  # block -> (chromosome code, start)
+        self.n_blocks = 0
+        self.starts = None  # first block of each region, if not regular
+
+    @staticmethod
+    def _codes(values: pd.Series, names: Dict[str, int]) -> np.ndarray:
+        # codes in order of first appearance, so chromosome codes follow
+        # the order of the file
+        for name in pd.unique(values):
+            names.setdefault(name, len(names))
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            lookup = np.array(
+                [names.get(name, -1) for name in values.cat.categories],
+                dtype=np.int64,
+            )
+            return lookup[values.cat.codes.to_numpy()]
+        return values.map(names).to_numpy(dtype=np.int64)
+
+    def add(
+        self,
+        chroms: pd.Series,
+        starts: pd.Series,
+        barcodes: pd.Series,
+        base: int,
+        data: bytes,
+    ):
+        """Index the records of data, one per line, that will be written
+        at uncompressed offset base of the file.
+        """
+
+        if len(data) == 0:
+            return
+        blocks = line_starts(data, base) // BGZF_BLOCK_SIZE
+        self.n_blocks = max(self.n_blocks, int(blocks[-1]) + 1)
+        codes = self._codes(barcodes, self.barcodes)
+        keys, counts = np.unique(
+            (blocks // BARCODE_INDEX_BLOCKS) << 32 | codes, return_counts=True
+        )
+        self.entries.append((keys >> 32, keys & 0xFFFFFFFF, counts))
+
+        chrom_codes = self._codes(chroms, self.chroms)
+        start_values = starts.to_numpy(dtype=np.int64)
+        firsts, rows = np.unique(blocks, return_index=True)
+        for block, row in zip(firsts.tolist(), rows.tolist()):
+            if block not in self.first:
+                self.first[block] = (
+                    int(chrom_codes[row]), int(start_values[row])
+                )
+
+    def region_starts(self) -> List[int]:
+        if self.starts is None:
+            return list(range(0, self.n_blocks, BARCODE_INDEX_BLOCKS))
+        return self.starts
+
+    def extend(self, other: "BarcodeBlockIndex", block_shift: int):
+        """Append the index of a file written directly after this one,
+        which starts at block block_shift; the regions of both are kept.
+        """
+
+        starts = self.region_starts()
+        region_shift = len(starts)
+        self.starts = starts + [b + block_shift for b in other.region_starts()]
+        barcodes = np.array(
+            [
+                self.barcodes.setdefault(b, len(self.barcodes))
+                for b in other.barcodes
+            ],
+            dtype=np.int64,
+        )
+        chroms = [
+            self.chroms.setdefault(c, len(self.chroms)) for c in other.chroms
+        ]
+        for regions, codes, counts in other.entries:
+            self.entries.append(
+                (regions + region_shift, barcodes[codes], counts)
+            )
+        for block, (chrom, start) in other.first.items():
+            self.first[block + block_shift] = (chroms[chrom], start)
+        self.n_blocks = block_shift + other.n_blocks
+
+    def write(self, path: str, blocks: List[Tuple[int, int]]):
+        """Write the index to path with the (uncompressed, compressed)
+        offsets of every block, followed by the offsets of the end.
+        """
+
+        n_blocks = len(blocks) - 1
+        if self.entries:
+            regions, codes, counts = map(np.concatenate, zip(*self.entries))
+        else:
+            regions = codes = counts = np.zeros(0, dtype=np.int64)
+        keys, inverse = np.unique(regions << 32 | codes, return_inverse=True)
+        totals = np.bincount(inverse, weights=counts, minlength=len(keys))
+
+        first = np.full((n_blocks, 2), -1, dtype=np.int64)
+        for block, key in self.first.items():
+            first[block] = key
+
+        write_barcode_index(
+            path,
+            blocks,
+            self.region_starts() + [n_blocks],
+            keys >> 32,
+            keys & 0xFFFFFFFF,
+            totals.astype(np.int64),
+            list(self.barcodes),
+            list(self.chroms),
+            first,
+        )
+
+
+def write_barcode_index(
+    path: str,
+    blocks: List[Tuple[int, int]],
+    region_blocks: np.ndarray,
+    regions: np.ndarray,
+    codes: np.ndarray,
+    counts: np.ndarray,
+    barcodes: List[str],
+    chroms: List[str],
+    first: np.ndarray,
+):
+    """Save a barcode index as npz; (region, code, count) entries are
+    stored sorted by region, as a sparse region x barcode matrix.
+    """
+
+    order = np.lexsort((codes, regions))
+    indptr = np.searchsorted(
+        regions[order], np.arange(len(region_blocks)), side="left"
+    )
+    with open(path, "wb") as f:
+        np.savez_compressed(
+            f,
+            blocks=np.array(blocks, dtype=np.int64).reshape(-1, 2),
+            region_blocks=np.asarray(region_blocks, dtype=np.int64),
+            indptr=indptr.astype(np.int64),
+            codes=np.asarray(codes, dtype=np.int64)[order],
+            counts=np.asarray(counts, dtype=np.int64)[order],
+            barcodes=np.array(barcodes, dtype=str),
+            chroms=np.array(chroms, dtype=str),
+            first=first,
+        )
+
+
+class BgzfWriter:
+    """Write a BGZF (blocked gzip) file readable by gzip, bgzip and
+    tabix.  Blocks are compressed in parallel on a thread pool (zlib
+    releases the GIL) and written in order; with index=True a tabix
+    index is written to path + ".tbi" on close, and a barcode index
+    (BarcodeBlockIndex) to path + ".bci".  With eof=False the
+    file is a shard to be concatenated with others: no EOF block or index
+    file is written, and the caller merges blocks and index instead.
+    columnar, if given, is closed with the file; write_fragments also
+    writes the fragments to it (a FragmentsParquet).  profile, if given,
+    is a StageProfile timing the compression of every block.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        level: int = 6,
+        threads: int = None,
+        index: bool = False,
+        eof: bool = True,
+        profile=None,
+        columnar=None,
+    ):
+        self.path = path
+        self.handle = open(path, "wb")
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = (
+            ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        )
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.offset = 0  # uncompressed bytes written
+        self.emitted = 0  # uncompressed bytes compressed to the file
+        self.blocks = []  # (uncompressed, compressed) offset of each block
+        self.index = TabixIndex() if index else None
+        self.barcode_index = BarcodeBlockIndex() if index else None
+        self.eof = eof
+        self.profile = profile
+        self.columnar = columnar
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.offset += len(data)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.profile is None:
+            return bgzf_block(data, self.level)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        block = bgzf_block(data, self.level)
+        self.profile.add(
+            "compress",
+            time.perf_counter() - wall,
+            time.thread_time() - cpu,
+            nbytes=len(data),
+        )
+        return block
+
+    def _write_block(self, data: bytes):
+        if self.executor is None:
+            self._emit(self._compress(data), len(data))
+            return
+        self.pending.append(
+            (self.executor.submit(self._compress, data), len(data))
+        )
+        # Bound the number of blocks held in memory
+        while len(self.pending) > 4 * self.threads:
+            self._emit_pending()
+
+    def _emit_pending(self):
+        future, size = self.pending.popleft()
+        self._emit(future.result(), size)
+
+    def _emit(self, block: bytes, size: int):
+        self.blocks.append((self.emitted, self.handle.tell()))
+        self.emitted += size
+        self.handle.write(block)
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._emit_pending()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.blocks.append((self.emitted, self.handle.tell()))
+        if self.eof:
+            self.handle.write(BGZF_EOF)
+        self.handle.close()
+        if self.eof and self.index is not None and self.index.refs:
+            self.index.write(f"{self.path}.tbi", self.blocks)
+            self.barcode_index.write(f"{self.path}.bci", self.blocks)
+        if self.columnar is not None:
+            self.columnar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_bgzf(path: str) -> bool:
+    """Return whether path starts with a BGZF block header."""
+
+    with open(path, "rb") as handle:
+        header = handle.read(16)
+    return (
+        len(header) == 16
+        and header[:4] == b"\x1f\x8b\x08\x04"
+        and header[12:14] == b"BC"
+    )
+
+
+def read_bgzf_header(handle) -> Tuple[bytes, int]:
+    """Read the header of the BGZF block at the current position of
+    handle; return the header bytes and the total size of the block, or
+    (b"", 0) at end of file.
+    """
+
+    header = handle.read(12)
+    if not header:
+        return b"", 0
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        raise ValueError("Input is not a valid BGZF file.")
+    (xlen,) = struct.unpack("<H", header[10:12])
+    extra = handle.read(xlen)
+    pos = 0
+    while pos + 4 <= xlen:
+        si1, si2, slen = struct.unpack("<BBH", extra[pos : pos + 4])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            (bsize,) = struct.unpack("<H", extra[pos + 4 : pos + 6])
+            return header + extra, bsize + 1
+        pos += 4 + slen
+    raise ValueError("BGZF block without a BSIZE field.")
+
+
+def read_bgzf_blocks(handle) -> Iterator[bytes]:
+    """Yield the raw (compressed) BGZF blocks of handle in order, using
+    the BSIZE field of each header to find the next block.
+    """
+
+    while True:
+        header, block_size = read_bgzf_header(handle)
+        if not header:
+            return
+        yield header + handle.read(block_size - len(header))
+
+
+def bgzf_block_offsets(path: str) -> List[int]:
+    """Return the compressed offset of every block of a BGZF file,
+    reading only the block headers.
+    """
+
+    offsets = []
+    with open(path, "rb") as handle:
+        while True:
+            offset = handle.tell()
+            header, block_size = read_bgzf_header(handle)
+            if not header:
+                return offsets
+            offsets.append(offset)
+            handle.seek(offset + block_size)
+
+
+def inflate_bgzf_block(block: bytes) -> bytes:
+    """Decompress one raw BGZF block."""
+
+    (xlen,) = struct.unpack("<H", block[10:12])
+    return zlib.decompress(block[12 + xlen : -8], -15)
+
+
+def read_bgzf_lines(
+    path: str,
+    chunksize: int,
+    threads: int = None,
+    start: int = 0,
+    end: int = None,
+) -> Iterator[bytes]:
+    """Yield the decompressed content of a BGZF file in order, as runs of
+    chunksize whole lines.  Blocks are independent gzip members and are
+    inflated in parallel on a thread pool.
+
+    start and end restrict reading to the blocks in that range of
+    compressed offsets (block aligned).  The first line starting at or
+    after a range boundary belongs to the range before it: that range
+    reads on to its newline, and the range after skips up to it.
+    """
+
+    threads = threads or os.cpu_count() or 1
+    buffer = bytearray()
+    n_lines = 0
+    skip_head = start > 0
+
+    def take_lines(data: bytes) -> Iterator[bytes]:
+        nonlocal n_lines, skip_head
+        if skip_head:
+            newline = data.find(b"\n")
+            if newline < 0:
+                return
+            data = data[newline + 1 :]
+            skip_head = False
+        buffer.extend(data)
+        n_lines += data.count(b"\n")
+        while n_lines >= chunksize:
+            newlines = np.flatnonzero(
+                np.frombuffer(buffer, dtype=np.uint8) == 10
+            )
+            cut = newlines[chunksize - 1] + 1
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+            n_lines -= chunksize
+
+    with open(path, "rb") as handle, ThreadPoolExecutor(threads) as pool:
+        handle.seek(start)
+        pending = collections.deque()
+        while end is None or handle.tell() < end:
+            header, block_size = read_bgzf_header(handle)
+            if not header:
+                break
+            block = header + handle.read(block_size - len(header))
+            pending.append(pool.submit(inflate_bgzf_block, block))
+            # Bound the number of blocks held in memory
+            if len(pending) > 4 * threads:
+                yield from take_lines(pending.popleft().result())
+        while pending:
+            yield from take_lines(pending.popleft().result())
+
+        # Finish the line crossing the end of the range
+        if end is not None and not skip_head:
+            for block in read_bgzf_blocks(handle):
+                data = inflate_bgzf_block(block)
+                newline = data.find(b"\n")
+                if newline >= 0:
+                    yield from take_lines(data[: newline + 1])
+                    break
+                yield from take_lines(data)
+
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+def read_barcode_index(path: str) -> Dict[str, np.ndarray]:
+    """Load a barcode index written by write_barcode_index."""
+
+    with np.load(path, allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+class BgzfReader:
+    """Random access by uncompressed offset to a BGZF file whose block
+    offsets are known, as (uncompressed, compressed) rows followed by
+    the offsets of the end.  Inflated blocks are cached until clear.
+    """
+
+    def __init__(self, path: str, blocks: np.ndarray):
+        self.handle = open(path, "rb")
+        self.blocks = blocks
+        self.u_starts = blocks[:, 0]
+        self.size = int(blocks[-1, 0])
+        self.cache = {}
+
+    def block(self, b: int) -> bytes:
+        if b not in self.cache:
+            self.handle.seek(self.blocks[b, 1])
+            self.cache[b] = inflate_bgzf_block(
+                self.handle.read(self.blocks[b + 1, 1] - self.blocks[b, 1])
+            )
+        return self.cache[b]
+
+    def block_of(self, u: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.u_starts, u, side="right") - 1
+
+    def read(self, u_start: int, u_end: int) -> bytes:
+        if u_end <= u_start:
+            return b""
+        first = int(self.block_of(u_start))
+        last = int(np.searchsorted(self.u_starts, u_end, side="left"))
+        data = b"".join(self.block(b) for b in range(first, last))
+        base = int(self.u_starts[first])
+        return data[u_start - base : u_end - base]
+
+    def line_start(self, u: int) -> int:
+        """Offset of the first line starting at or after u."""
+
+        if u == 0 or u >= self.size or self.read(u - 1, u) == b"\n":
+            return min(u, self.size)
+        b = int(self.block_of(u))
+        while b < len(self.blocks) - 1:
+            newline = self.block(b).find(b"\n", u - int(self.u_starts[b]))
+            if newline >= 0:
+                return int(self.u_starts[b]) + newline + 1
+            b += 1
+            u = int(self.u_starts[b])
+        return self.size
+
+    def copy(self, first: int, last: int, out):
+        """Copy blocks first..last - 1 to out as stored."""
+
+        self.handle.seek(self.blocks[first, 1])
+        remaining = int(self.blocks[last, 1] - self.blocks[first, 1])
+        while remaining > 0:
+            data = self.handle.read(min(remaining, 16 * 1024**2))
+            out.write(data)
+            remaining -= len(data)
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.handle.close()
+
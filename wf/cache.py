@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from typing import Optional
+
+if __package__:
+    from .clean import file_digest
+else:
+    from clean import file_digest
+
+logging.basicConfig(
+    format="%(levelname)s - %(asctime)s - %(message)s", level=logging.INFO
+)
+
+ENGINE_PATHS = [
+    os.path.join(os.path.dirname(__file__), name)
+    for name in ["clean.py", "bgzf.py", "update.py"]
+]
+
+
+def code_version() -> str:
+    """Digest of the cleaning engine sources; any change to them
+    invalidates cached outputs.
+    """
+
+    digests = [file_digest(path) for path in ENGINE_PATHS]
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+
+def cache_key(
+    run_id: str,
+    singlecell_path: str,
+    position_path: str,
+    fragments_path: str,
+    deviations: float,
+    degree: int = 1,
+    seed: int = None,
+    parquet: bool = False,
+) -> str:
+    """Content address of a cleaning run: a digest of the input file
+    contents, the run parameters and the code version.  run_id is part of
+    the key as it names the output files and fills the metrics.
+    """
+
+    fields = {
+        "run_id": run_id,
+        "singlecell": file_digest(singlecell_path),
+        "positions": file_digest(position_path),
+        "fragments": file_digest(fragments_path),
+        "deviations": deviations,
+        "degree": degree,
+        "seed": seed,
+        "parquet": parquet,
+        "code": code_version(),
+    }
+    encoded = json.dumps(fields, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class LocalCache:
+    """Cleaned output directories stored under a local root, one
+    subdirectory per key, with the interface of LatchCache; an entry
+    appears atomically once complete.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Directory of the entry for key, if any."""
+
+        path = self.path(key)
+        return path if os.path.isdir(path) else None
+
+    def put(self, key: str, out_dir: str) -> Optional[str]:
+        """Copy out_dir into the cache as the entry for key."""
+
+        path = self.path(key)
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.root, prefix=f".{key}.")
+        try:
+            shutil.copytree(out_dir, staging, dirs_exist_ok=True)
+            os.rename(staging, path)
+        except OSError as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(path):
+                logging.warning(f"Cache store of {key} failed: {e}")
+                return None
+        return path
+
+    def restore(self, key: str, out_dir: str) -> bool:
+        """Copy the entry for key to out_dir; False if that failed."""
+
+        try:
+            shutil.copytree(self.path(key), out_dir, dirs_exist_ok=True)
+            return True
+        except OSError as e:
+            logging.warning(f"Cache restore of {key} failed: {e}")
+            return False
+
+
+class LatchCache:
+    """Cleaned output directories stored under a latch root, one per key.
+    As keys are content addresses, an entry never changes once written; a
+    marker file uploaded after its outputs completes it, so an entry is
+    only a hit once its upload has finished.
+    """
+
+    def __init__(self, root: str = "latch:///cleaned/.cache"):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return f"{self.root}/{key}"
+
+    def marker(self, key: str) -> str:
+        return f"{self.root}/{key}.done"
+
+    def get(self, key: str) -> Optional[str]:
+        """Remote directory of the complete entry for key, if any."""
+
+        from latch.ldata.path import LPath
+
+        try:
+            if not LPath(self.marker(key)).exists():
+                return None
+            return self.path(key)
+        except Exception as e:
+            logging.warning(f"Cache lookup of {key} failed: {e}")
+            return None
+
+    def put(self, key: str, out_dir: str) -> Optional[str]:
+        """Upload the local out_dir as the entry for key, then complete
+        it.
+        """
+
+        from latch.ldata.path import LPath
+
+        try:
+            LPath(self.path(key)).upload_from(out_dir)
+            with tempfile.TemporaryDirectory() as tmp:
+                local = os.path.join(tmp, f"{key}.done")
+                with open(local, "w") as f:
+                    f.write(key)
+                LPath(self.marker(key)).upload_from(local)
+            return self.path(key)
+        except Exception as e:
+            logging.warning(f"Cache store of {key} failed: {e}")
+            return None
+
+    def restore(self, key: str, remote_dir: str) -> bool:
+        """Copy the entry for key to remote_dir; False if that failed."""
+
+        from latch.ldata.path import LPath
+
+        try:
+            LPath(self.path(key)).copy_to(LPath(remote_dir))
+            return True
+        except Exception as e:
+            logging.warning(f"Cache restore of {key} failed: {e}")
+            return False
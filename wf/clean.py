@@ -1,21 +1,132 @@
+import collections
+import contextlib
 import csv
+import hashlib
+import io
+import itertools
+import json
 import logging
 import math
 import numpy as np
+import os
 import pandas as pd
+import pickle
+import queue
+import re
+import resource
+import shutil
 import statistics
 import sys
+import tempfile
+import threading
+import time
 
-from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+# Run as a script (python wf/clean.py), the engine imports its sibling
+# modules from its own directory
+if __package__:
+    from .bgzf import (
+        BGZF_EOF,
+        BarcodeBlockIndex,
+        BgzfWriter,
+        TabixIndex,
+        bgzf_block_offsets,
+        is_bgzf,
+        read_bgzf_lines,
+    )
+else:
+    from bgzf import (
+        BGZF_EOF,
+        BarcodeBlockIndex,
+        BgzfWriter,
+        TabixIndex,
+        bgzf_block_offsets,
+        is_bgzf,
+        read_bgzf_lines,
+    )
 
 logging.basicConfig(
     format="%(levelname)s - %(asctime)s - %(message)s", level=logging.INFO
 )
 
-metrics_output = None
-bad_elements = []
-number_of_channels = None
+POSITIONS_COLUMNS = ["barcodes", "on_off", "row", "col"]
+POSITIONS_DTYPES = {
+    "barcodes": "category",
+    "on_off": np.int8,
+    "row": np.int16,
+    "col": np.int16,
+}
+# Parsed positions files kept by a Cleaner, keyed by content digest
+GRID_CACHE_SIZE = 8
+DIGEST_BLOCK_SIZE = 1024**2
+
+FRAGMENT_COLUMNS = ["V1", "V2", "V3", "barcodes", "V4"]
+# Chromosomes and barcodes are dictionary encoded; counts are read as
+# uint32 and narrowed to uint16 by compact_fragments when they fit
+FRAGMENT_DTYPES = {
+    "V1": "category",
+    "V2": np.uint32,
+    "V3": np.uint32,
+    "barcodes": "category",
+    "V4": np.uint32,
+}
+DEFAULT_CHUNKSIZE = 2_000_000
+
+# Columns of the optional Parquet copy of the cleaned fragments; every
+# row group holds a single chromosome and at most PARQUET_ROW_GROUP_ROWS
+PARQUET_COLUMNS = ["chrom", "start", "end", "barcode", "count"]
+PARQUET_ROW_GROUP_ROWS = 1_000_000
+
+# Peak memory model of the streaming engine: interpreter and imports, per
+# row of a parsed chunk, per fragment of the chromosome held by the sort
+# fallback, per byte of singlecell csv.  Fit with some margin to the peak
+# RSS of benchmarks/bench.py (stream and sort modes, 50 channels, default
+# chunksize) on 1M, 2M, 4M and 6M fragments: 468, 712, 776 and 805 MiB
+# with sorted input, 284, 484, 659 and 746 MiB with shuffled input; the
+# model gives 525, 793, 842 and 891 MiB
+MEMORY_BASE = 256 * 1024**2
+MEMORY_PER_CHUNK_ROW = 256
+MEMORY_PER_SORTED_ROW = 256
+MEMORY_PER_SINGLECELL_BYTE = 8
+# Conservative bytes per gzipped fragment line and the largest share of
+# fragments on one chromosome (chr1 is about 8% of hg38 and mm10)
+GZIP_BYTES_PER_FRAGMENT = 12
+LARGEST_CHROMOSOME_SHARE = 0.1
+
 
+METRICS_KEYS = ["run_id", "row", "col", "down", "og", "final", "pct"]
+SWEEP_KEYS = ["deviations", "row", "col", "down", "og", "final", "pct"]
+METRICS_FIELDS = [
+    "Run_Id",
+    "Rows downsampled",
+    "Columns downsampled",
+    "Diagonal downsampled",
+    "Original fragments",
+    "Final fragments",
+    "pct_diff",
+]
+SWEEP_FIELDS = ["Deviations"] + METRICS_FIELDS[1:]
+
+# (row, col) offset of each first-degree neighbor
+NEIGHBOR_OFFSETS = {
+    "r": (0, 1),
+    "l": (0, -1),
+    "d": (1, 0),
+    "u": (-1, 0),
+    "lu": (-1, -1),
+    "ld": (1, -1),
+    "ru": (-1, 1),
+    "rd": (1, 1),
+}
+DIAGONAL_WEIGHT = 0.7
+# With degree > 1 the neighborhood is the (2 * degree + 1)^2 window; the
+# tixels d steps away are weighted by DISTANCE_DECAY ** (d - 1), and the
+# off-axis ones further by DIAGONAL_WEIGHT.  As the weights scale the
+# averaged terms, a decay below 1 also lowers the targets.
+DISTANCE_DECAY = 1.0
 
 def average_duplicates(big_list: List[List[int]]) -> Dict[str, float]:
     """Combine row, col, diag reduction lists; if a barcode occurs in
@@ -40,87 +151,402 @@ def average_duplicates(big_list: List[List[int]]) -> Dict[str, float]:
     return final
 
 
-def filter_sc(singlecell_path: str, position_path: str) -> pd.DataFrame:
-    """Reformat data, remove headers, apply custom column names for
-    dataframes, add -1 to positions, remove off tixels.
+def reset_peak_rss():
+    """Reset the peak RSS of the process (VmHWM) to its current RSS, where
+    procfs allows it, so that a run in a reused worker process measures
+    its own peak.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """Peak RSS of the process in bytes since the last reset_peak_rss;
+    without procfs, since the process started.
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageProfile:
+    """Wall time, CPU time and rows/bytes processed per stage of a run,
+    with the process peak RSS when each stage last finished; the peak is
+    reset when the profile is created.  Stages can be entered many times
+    (once per chunk) and from several threads; their figures add up.  CPU
+    time is process wide, so it includes threads working for other
+    stages at the same time.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        reset_peak_rss()
+
+    def add(
+        self,
+        name: str,
+        wall: float,
+        cpu: float,
+        rows: int = 0,
+        nbytes: int = 0,
+        calls: int = 1,
+        peak: int = None,
+    ):
+        if peak is None:
+            peak = peak_rss()
+        with self.lock:
+            stage = self.stages.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "wall_s": 0.0,
+                    "cpu_s": 0.0,
+                    "rows": 0,
+                    "bytes": 0,
+                    "peak_rss_bytes": 0,
+                },
+            )
+            stage["calls"] += calls
+            stage["wall_s"] += wall
+            stage["cpu_s"] += cpu
+            stage["rows"] += int(rows)
+            stage["bytes"] += int(nbytes)
+            stage["peak_rss_bytes"] = max(stage["peak_rss_bytes"], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows: int = 0, nbytes: int = 0):
+        """Time the body as stage name; it may update the yielded
+        {"rows", "bytes"} counts.
+        """
+
+        counts = {"rows": rows, "bytes": nbytes}
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield counts
+        finally:
+            self.add(
+                name,
+                time.perf_counter() - wall,
+                time.process_time() - cpu,
+                counts["rows"],
+                counts["bytes"],
+            )
+
+    def iterate(
+        self, name: str, chunks: Iterable[pd.DataFrame]
+    ) -> Iterator[pd.DataFrame]:
+        """Yield chunks, timing the production of each as stage name."""
+
+        chunks = iter(chunks)
+        while True:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            self.add(
+                name,
+                time.perf_counter() - wall,
+                time.process_time() - cpu,
+                chunk.shape[0],
+            )
+            yield chunk
+
+    def merge(self, stages: Dict[str, dict]):
+        """Add the stages of a profile taken in another process, such as
+        a shard's; wall and CPU times add up across processes and the
+        peak is the largest of them.
+        """
+
+        for name, stage in stages.items():
+            self.add(
+                name,
+                stage["wall_s"],
+                stage["cpu_s"],
+                stage["rows"],
+                stage["bytes"],
+                stage["calls"],
+                stage["peak_rss_bytes"],
+            )
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.stages, f, indent=2)
+
+
+def file_digest(path: str) -> str:
+    """sha256 hex digest of a file's content."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class ChipGrid:
+    """What cleaning needs from a positions file: the number of channels
+    and, per tixel, its barcode (suffixed with -1 and dictionary encoded,
+    so its codes index the tixels), on/off flag, row and column.
+    """
+
+    channels: int
+    positions: pd.DataFrame
+
+    @classmethod
+    def from_positions(cls, position_path: str) -> "ChipGrid":
+        positions = pd.read_csv(
+            position_path,
+            header=None,
+            usecols=[0, 1, 2, 3],
+            names=POSITIONS_COLUMNS,
+            dtype=POSITIONS_DTYPES,
+        )
+        barcodes = positions["barcodes"].cat
+        positions["barcodes"] = barcodes.rename_categories(
+            barcodes.categories + "-1"
+        )
+        return cls(
+            channels=int(math.sqrt(positions.shape[0])),
+            positions=positions,
+        )
+
+
+class GridCache:
+    """Parsed positions files, keyed by content digest, as one positions
+    file usually serves a whole samplesheet.  Safe to share between
+    threads, and can be sent to worker processes with its grids; the
+    grids returned are shared and must not be modified.
     """
 
-    global number_of_channels
+    def __init__(self, size: int = GRID_CACHE_SIZE):
+        self.size = size
+        self.grids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        with self.lock:
+            return {"size": self.size, "grids": self.grids.copy()}
+
+    def __setstate__(self, state):
+        self.size = state["size"]
+        self.grids = state["grids"]
+        self.lock = threading.Lock()
+
+    def get(self, position_path: str) -> ChipGrid:
+        key = file_digest(position_path)
+        with self.lock:
+            if key in self.grids:
+                self.grids.move_to_end(key)
+                return self.grids[key]
+
+        grid = ChipGrid.from_positions(position_path)
+        with self.lock:
+            self.grids[key] = grid
+            if len(self.grids) > self.size:
+                self.grids.popitem(last=False)
+        return grid
+
+
+def filter_sc(
+    singlecell_path: str, position_path: str, grids: GridCache = None
+) -> Tuple[pd.DataFrame, int]:
+    """Reformat data, remove headers, apply custom column names for
+    dataframes, add -1 to positions, remove off tixels.  Returns the
+    filtered table and the number of channels of the chip.  The positions
+    file is looked up in grids if given.
+    """
 
     singlecell = pd.read_csv(singlecell_path, usecols=[0, 2])
     if singlecell.iloc[0, 0] == "NO_BARCODE":
         singlecell = singlecell.drop(0, axis=0)
 
-    positions = pd.read_csv(position_path, header=None, usecols=[0, 1, 2, 3])
-    positions.columns = ["barcodes", "on_off", "row", "col"]
-    number_of_channels = math.sqrt(positions.shape[0])
-    positions["barcodes"] = positions.loc[:, "barcodes"].apply(lambda x: x + "-1")
+    if grids is not None:
+        grid = grids.get(position_path)
+    else:
+        grid = ChipGrid.from_positions(position_path)
+    positions = grid.positions
+    number_of_channels = grid.channels
 
-    merged = pd.merge(positions.astype(object), singlecell.astype(object))
-    filtered = merged[merged["on_off"] == 1]
+    # join on the codes of the positions barcodes; unknown barcodes get -1
+    barcodes = positions["barcodes"].cat
+    singlecell_codes = pd.Categorical(
+        singlecell.iloc[:, 0], categories=barcodes.categories
+    ).codes
+    left = positions[positions["on_off"] == 1]
+    right = singlecell.iloc[:, 1:][singlecell_codes >= 0]
+    right.insert(0, "code", singlecell_codes[singlecell_codes >= 0])
+    filtered = pd.merge(
+        left.assign(code=left["barcodes"].cat.codes), right, on="code"
+    ).drop(columns="code")
 
-    return filtered
+    return filtered, number_of_channels
 
 
-def get_neighbors(current_value: int, repeat: List[int]) -> List[int]:
-    global bad_elements
-    global number_of_channels
-
-    all_neighbors = {}
-    row = current_value[0]
-    col = current_value[1]
-
-    # right
-    if col + 1 < number_of_channels and [row, col + 1] not in bad_elements:
-        all_neighbors["r"] = [row, col + 1]
-    # left
-    if col - 1 >= 0 and [row, col - 1] not in bad_elements:
-        all_neighbors["l"] = [row, col - 1]
-    # down
-    if row + 1 < number_of_channels and [row + 1, col] not in bad_elements:
-        all_neighbors["d"] = [row + 1, col]
-    # up
-    if row - 1 >= 0 and [row - 1, col] not in bad_elements:
-        all_neighbors["u"] = [row - 1, col]
-    # leftUp
-    if row - 1 >= 0 and col - 1 >= 0 and [row - 1, col - 1] not in bad_elements:
-        all_neighbors["lu"] = [row - 1, col - 1]
-    # leftDown
-    if (
-        row + 1 < number_of_channels
-        and col - 1 >= 0
-        and [row + 1, col - 1] not in bad_elements
-    ):
-        all_neighbors["ld"] = [row + 1, col - 1]
-    # rightUp
-    if (
-        row - 1 >= 0
-        and col + 1 < number_of_channels
-        and [row - 1, col + 1] not in bad_elements
-    ):
-        all_neighbors["ru"] = [row - 1, col + 1]
-    # rightDown
-    if (
-        row + 1 < number_of_channels
-        and col + 1 < number_of_channels
-        and [row + 1, col + 1] not in bad_elements
-    ):
-        all_neighbors["rd"] = [row + 1, col + 1]
+class TixelMask:
+    """Grid-indexed bitmap of tixels in flagged lanes; membership tests
+    are O(1) per tixel.
+    """
+
+    def __init__(self, channels: int):
+        self.channels = channels
+        self.grid = np.zeros((channels, channels), dtype=bool)
+
+    def add(self, rows: np.ndarray, cols: np.ndarray):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        self.grid[rows, cols] = True
+
+    def __contains__(self, tixel: List[int]) -> bool:
+        return bool(self.grid[tixel[0], tixel[1]])
+
+
+def to_grid(
+    singlecell: pd.DataFrame, values: np.ndarray, channels: int, fill=0
+) -> np.ndarray:
+    """Scatter one value per singlecell row into a dense
+    (channels x channels) array indexed by [row, col].
+    """
+
+    values = np.asarray(values)
+    grid = np.full((channels, channels), fill, dtype=values.dtype)
+    grid[
+        singlecell["row"].to_numpy(dtype=np.int64),
+        singlecell["col"].to_numpy(dtype=np.int64),
+    ] = values
+    return grid
+
+
+def shift_grid(grid: np.ndarray, d_row: int, d_col: int) -> np.ndarray:
+    """Return array where out[r, c] == grid[r + d_row, c + d_col], zero
+    outside of the chip.
+    """
+
+    n_rows, n_cols = grid.shape
+    pad = max(abs(d_row), abs(d_col), 1)
+    padded = np.pad(grid, pad)
+    return padded[
+        pad + d_row : pad + d_row + n_rows, pad + d_col : pad + d_col + n_cols
+    ]
+
+
+def window_sums(grid: np.ndarray, radius: int) -> List[np.ndarray]:
+    """Return, for d in 0..radius, the sum of grid over the
+    (2d + 1) x (2d + 1) window centred on every cell, zero outside of
+    the chip; all windows come from one summed-area table.
+    """
+
+    n_rows, n_cols = grid.shape
+    integral = np.zeros(
+        (n_rows + 2 * radius + 1, n_cols + 2 * radius + 1), dtype=grid.dtype
+    )
+    integral[1:, 1:] = np.pad(grid, radius).cumsum(axis=0).cumsum(axis=1)
+
+    sums = []
+    for d in range(radius + 1):
+        lo = radius - d
+        hi = radius + d + 1
+        sums.append(
+            integral[hi : hi + n_rows, hi : hi + n_cols]
+            - integral[lo : lo + n_rows, hi : hi + n_cols]
+            - integral[hi : hi + n_rows, lo : lo + n_cols]
+            + integral[lo : lo + n_rows, lo : lo + n_cols]
+        )
+    return sums
 
-    return all_neighbors
 
+def window_means(
+    passed: np.ndarray,
+    usable: np.ndarray,
+    degree: int,
+    decay: float = DISTANCE_DECAY,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (mean, count) grids of the weighted passed_filters of the
+    usable tixels within degree steps of every tixel.  Ring d of the
+    window is the difference of two window sums; its four on-axis tixels
+    come from shifts, so the cost grows with degree, not its square.
+    """
 
-def multiple_degree(
-    first_neighbors: List[int], degree: int, current: int
-) -> List[int]:
-    current_neighbors = first_neighbors.copy()
-    actual_degree = degree - 1
-    for i in first_neighbors:
-        for x in range(actual_degree):
-            children = get_neighbors(i, current_neighbors)
-            current_neighbors += children
-    current_neighbors.remove(current)
-    return current_neighbors
+    value = np.where(usable, passed, 0).astype(np.int64)
+    used = usable.astype(np.int64)
+    value_sums = window_sums(value, degree)
+    used_sums = window_sums(used, degree)
+
+    total = np.zeros(passed.shape, dtype=np.float64)
+    count = np.zeros(passed.shape, dtype=np.int64)
+    for d in range(1, degree + 1):
+        ring = value_sums[d] - value_sums[d - 1]
+        axis = sum(
+            shift_grid(value, d_row, d_col)
+            for d_row, d_col in ((0, d), (0, -d), (d, 0), (-d, 0))
+        )
+        total += decay ** (d - 1) * (axis + DIAGONAL_WEIGHT * (ring - axis))
+        count += used_sums[d] - used_sums[d - 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = total / count
+    return means, count
+
+
+def neighbor_terms(
+    passed: np.ndarray, usable: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return stacked (neighbors x channels x channels) arrays of the
+    weighted passed_filters of each neighbor of every tixel and whether
+    that neighbor is usable; diagonal neighbors are weighted by
+    DIAGONAL_WEIGHT.
+    """
+
+    value = np.where(usable, passed, 0.0)
+    terms = []
+    present = []
+    for key, (d_row, d_col) in NEIGHBOR_OFFSETS.items():
+        weight = DIAGONAL_WEIGHT if len(key) == 2 else 1.0
+        terms.append(shift_grid(value, d_row, d_col) * weight)
+        present.append(shift_grid(usable, d_row, d_col))
+
+    return np.stack(terms), np.stack(present)
+
+
+def neighbor_means(
+    terms: np.ndarray, present: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (mean, count) of the present terms of each column.
+
+    Matches statistics.mean exactly: sums are accumulated with an exact
+    error term, and the few columns whose float sum was rounded are
+    recomputed with statistics.mean.
+    """
+
+    total = np.zeros(terms.shape[1:], dtype=np.float64)
+    rounded = np.zeros(terms.shape[1:], dtype=bool)
+    for term in terms:
+        new_total = total + term
+        back = new_total - total
+        rounded |= ((total - (new_total - back)) + (term - back)) != 0
+        total = new_total
+    count = present.sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = total / count
+    for i in np.flatnonzero(rounded & (count > 0)):
+        means[i] = statistics.mean(terms[present[:, i], i].tolist())
+
+    return means, count
 
 
 def neighbors_reductions(
@@ -129,104 +555,167 @@ def neighbors_reductions(
     degree: int,
     global_mean: float,
     axis_id: str,
+    bad_elements: TixelMask,
+    decay: float = DISTANCE_DECAY,
 ) -> pd.DataFrame:
     """Return table with barcode|barcode_index|adjust where "adjust"
     is the new value to reduce outlier lanes to; table to be used to
-    reduce fragments.tsv
+    reduce fragments.tsv.  "adjust" is the mean weighted passed_filters of
+    the usable tixels within degree steps.
     """
 
-    singlecell["adjust"] = 0
-    for i in outliers:
-        current_tixel = singlecell.iloc[i]
-        row = current_tixel["row"]
-        col = current_tixel["col"]
-        neighbors = get_neighbors([row, col], [])
-        on_tixels = []
-        for x, j in neighbors.items():
-            try:
-                current_neighbor = singlecell.loc[
-                    (singlecell["row"] == j[0]) & (singlecell["col"] == j[1])
-                ]
-                if x not in ["lu", "ld", "ru", "rd"]:
-                    on_tixels.append(current_neighbor["passed_filters"].values[0])
-                else:
-                    on_tixels.append(current_neighbor["passed_filters"].values[0] * 0.7)
-            except Exception as e:
-                pass
-        if len(on_tixels) > 0:
-            mean = statistics.mean(on_tixels)
-        else:
-            if axis_id != "diag":
-                normalized_median = global_mean / singlecell.iloc[[i], [1]].values[0][0]
-                mean = singlecell.iloc[[i], [4]].values[0][0] * normalized_median
-            else:
-                mean = singlecell.iloc[[i], [4]].values[0][0] * global_mean
-        singlecell.iloc[[i], [5]] = mean
+    singlecell["adjust"] = 0.0
+    outliers = np.asarray(outliers, dtype=np.int64)
+    if outliers.size == 0:
+        return singlecell.loc[[], ["barcodes", "adjust"]]
+
+    # Neighbors count if they are on tissue and not in a flagged lane
+    passed = singlecell["passed_filters"].to_numpy(dtype=np.float64)
+    channels = bad_elements.channels
+    usable = to_grid(
+        singlecell, np.ones(len(singlecell), dtype=bool), channels
+    )
+    usable &= ~bad_elements.grid
+    passed_grid = to_grid(singlecell, passed, channels)
+
+    rows = singlecell["row"].to_numpy(dtype=np.int64)[outliers]
+    cols = singlecell["col"].to_numpy(dtype=np.int64)[outliers]
+    if degree <= 1:
+        # the eight neighbors term by term, exact to statistics.mean
+        terms, present = neighbor_terms(passed_grid, usable)
+        means, n_neighbors = neighbor_means(
+            terms[:, rows, cols], present[:, rows, cols]
+        )
+    else:
+        means, n_neighbors = window_means(passed_grid, usable, degree, decay)
+        means = means[rows, cols]
+        n_neighbors = n_neighbors[rows, cols]
+
+    # No usable neighbors; scale tixel by the lane median instead
+    if axis_id != "diag":
+        lane_medians = singlecell["on_off"].to_numpy(dtype=np.float64)
+        fallback = passed[outliers] * (global_mean / lane_medians[outliers])
+    else:
+        fallback = passed[outliers] * global_mean
+    means = np.where(n_neighbors > 0, means, fallback)
+    singlecell.iloc[outliers, singlecell.columns.get_loc("adjust")] = means
 
     sliced = singlecell[["barcodes", "adjust"]]
     filtered = sliced[sliced["adjust"] != 0]
     return filtered
 
 
+@dataclass
+class LaneStats:
+    """Median passed_filters of every row and column (indexed by lane),
+    the mean and standard deviation of those medians, and the diagonal
+    medians and mean.
+    """
+
+    row_medians: pd.Series
+    col_medians: pd.Series
+    row_mean: float
+    row_std: float
+    col_mean: float
+    col_std: float
+    tl_diag_median: float
+    tr_diag_median: float
+    diag_mean: float
+
+    def medians(self, axis_id: str) -> pd.Series:
+        return self.row_medians if axis_id == "row" else self.col_medians
+
+    def mean(self, axis_id: str) -> float:
+        return self.row_mean if axis_id == "row" else self.col_mean
+
+    def std(self, axis_id: str) -> float:
+        return self.row_std if axis_id == "row" else self.col_std
+
+    def to_dict(self) -> Dict:
+        stats = dict(vars(self))
+        for key in ("row_medians", "col_medians"):
+            stats[key] = {int(k): float(v) for k, v in stats[key].items()}
+        return stats
+
+    @classmethod
+    def from_dict(cls, stats: Dict) -> "LaneStats":
+        stats = dict(stats)
+        for key in ("row_medians", "col_medians"):
+            stats[key] = pd.Series(
+                {int(k): v for k, v in stats[key].items()}, dtype=np.float64
+            )
+        return cls(**stats)
+
+
+def get_lane_stats(singlecell: pd.DataFrame, channels: int) -> LaneStats:
+    """Compute all lane statistics in one vectorized pass over the
+    singlecell table.
+    """
+
+    passed = singlecell["passed_filters"].astype(np.float64)
+    rows = singlecell["row"].astype(np.int64)
+    cols = singlecell["col"].astype(np.int64)
+    row_medians = passed.groupby(rows).median()
+    col_medians = passed.groupby(cols).median()
+
+    tl_diag = rows == cols
+    tr_diag = (rows + cols) == (channels - 1)
+
+    # statistics on the (at most channels) medians keeps thresholds exact
+    return LaneStats(
+        row_medians=row_medians,
+        col_medians=col_medians,
+        row_mean=statistics.mean(row_medians.tolist()),
+        row_std=statistics.stdev(row_medians.tolist()),
+        col_mean=statistics.mean(col_medians.tolist()),
+        col_std=statistics.stdev(col_medians.tolist()),
+        tl_diag_median=passed[tl_diag].median(),
+        tr_diag_median=passed[tr_diag].median(),
+        diag_mean=passed[tl_diag | tr_diag].mean(),
+    )
+
+
 def get_reductions(
-    singlecell: pd.DataFrame, axis_id: str, deviations: int, degree: int
+    singlecell: pd.DataFrame,
+    axis_id: str,
+    deviations: float,
+    degree: int,
+    bad_elements: TixelMask,
+    metrics: Dict,
+    lane_stats: LaneStats = None,
+    decay: float = DISTANCE_DECAY,
 ) -> pd.DataFrame:
     """Return table with barcode|barcode_index|adjust where "adjust"
     is the new value to reduce outlier lanes to; table to be used to
-    reduce fragments.tsv
+    reduce fragments.tsv; tixels of outlier lanes are added to
+    bad_elements and the lanes are recorded in metrics.
     """
-    global metrics_output
-    global bad_elements
 
-    # calculate axis medians
-    str_length = singlecell[axis_id].unique().tolist()
-    all_indexes = {}
-    for i in str_length:
-        pre_list = np.where(singlecell[axis_id] == i)
-        indexes = pre_list[0].tolist()
-        pre_sort = singlecell.iloc[indexes]["passed_filters"].tolist()
-        pre_sort.sort()
-        all_indexes[i] = statistics.median(pre_sort)
+    if lane_stats is None:
+        lane_stats = get_lane_stats(singlecell, bad_elements.channels)
+    medians = lane_stats.medians(axis_id)
+    mean = lane_stats.mean(axis_id)
+    std = lane_stats.std(axis_id)
 
-    axisid_info = singlecell[["barcodes", axis_id]]
-    apply_medians = singlecell.loc[:, axis_id].apply(lambda x: all_indexes[x])
-    singlecell["on_off"] = apply_medians
-    og_singlecell = singlecell.copy()
-
-    mean = statistics.mean(list(all_indexes.values()))
-    std = statistics.stdev(list(all_indexes.values()))
+    lanes = singlecell[axis_id].to_numpy(dtype=np.int64)
+    singlecell["on_off"] = medians.reindex(lanes).to_numpy()
 
     # identify lanes more than x standard deviations above mean
     upper_limit = mean + deviations * std
+    outlier_lanes = medians.index[medians > upper_limit]
 
-    # Filter singlecell table to only outliers
-    singlecell = singlecell[singlecell["on_off"] > upper_limit]
-
-    # Store rows/cols being downsampled in global variable
-    bad_barcodes = singlecell["barcodes"].values.tolist()
-    downsampled_elements = set()
-    metric_elements = set()
-
-    for i in bad_barcodes:
-        correct_element = axisid_info.loc[axisid_info["barcodes"] == i]
-        convert_list = [[i, j] for i, j in correct_element.values.tolist()]
-        metric_elements.add(str(convert_list[0][1] + 1))  # +1 for 1-based
-        downsampled_elements.add(str(convert_list[0][1]))
-    set_to_string = ", ".join(metric_elements)
-    metrics_output[axis_id] = set_to_string
+    metrics[axis_id] = ", ".join(
+        str(i + 1) for i in outlier_lanes  # +1 for 1-based
+    )
 
     # Add "adjust" column containing value to reduce reads to
-    all_elem_ids = []
-    for i in downsampled_elements:
-        outlier_ids = np.where(og_singlecell[axis_id] == int(i))
-        all_elem_ids += outlier_ids[0].tolist()
-    for i in all_elem_ids:
-        element = og_singlecell.iloc[i]
-        row = element["row"]
-        col = element["col"]
-        bad_elements.append([row, col])
+    all_elem_ids = np.flatnonzero(np.isin(lanes, outlier_lanes))
+    bad_elements.add(
+        singlecell["row"].to_numpy(dtype=np.int64)[all_elem_ids],
+        singlecell["col"].to_numpy(dtype=np.int64)[all_elem_ids],
+    )
     updated_singlecell = neighbors_reductions(
-        og_singlecell, all_elem_ids, degree, mean, axis_id
+        singlecell, all_elem_ids, degree, mean, axis_id, bad_elements, decay
     )
 
     final = updated_singlecell
@@ -234,76 +723,122 @@ def get_reductions(
 
 
 def get_diag_reductions(
-    singlecell: pd.DataFrame, deviations: int, degree: int
+    singlecell: pd.DataFrame,
+    deviations: float,
+    degree: int,
+    bad_elements: TixelMask,
+    metrics: Dict,
+    lane_stats: LaneStats = None,
+    decay: float = DISTANCE_DECAY,
 ) -> pd.DataFrame:
     """Return reduction table for diagonal if median of diagonal counts
     an outlier compared to either rows or columns.
     """
-    global metrics_output
-
-    str_length_r = singlecell["row"].unique().tolist()
-    all_indexes_r = {}
-    for i in str_length_r:
-        pre_list = np.where(singlecell["row"] == i)
-        indexes = pre_list[0].tolist()
-        pre_sort = singlecell.iloc[indexes]["passed_filters"].tolist()
-        pre_sort.sort()
-        all_indexes_r[i] = statistics.median(pre_sort)
-
-    str_length_c = singlecell["col"].unique().tolist()
-    all_indexes_c = {}
-    for i in str_length_c:
-        pre_list = np.where(singlecell["col"] == i)
-        indexes = pre_list[0].tolist()
-        pre_sort = singlecell.iloc[indexes]["passed_filters"].tolist()
-        pre_sort.sort()
-        all_indexes_c[i] = statistics.median(pre_sort)
-
-    row_mean = statistics.mean(list(all_indexes_r.values()))
-    row_std = statistics.stdev(list(all_indexes_r.values()))
-    col_mean = statistics.mean(list(all_indexes_c.values()))
-    col_std = statistics.stdev(list(all_indexes_c.values()))
+
+    number_of_channels = bad_elements.channels
+    if lane_stats is None:
+        lane_stats = get_lane_stats(singlecell, number_of_channels)
+    row_mean = lane_stats.row_mean
+    col_mean = lane_stats.col_mean
+    diag_mean = lane_stats.diag_mean
 
     # identify limit more than x standard deviations above mean
-    rows_limit = row_mean + deviations * row_std
-    cols_limit = col_mean + deviations * col_std
+    rows_limit = row_mean + deviations * lane_stats.row_std
+    cols_limit = col_mean + deviations * lane_stats.col_std
 
     # create table with only diagonal tixels from singlecell table
     diag_sc = singlecell[(singlecell["row"] == singlecell["col"]) | ((singlecell["row"] + singlecell["col"]) == (number_of_channels - 1))]
     tl_diag = np.where(singlecell["row"] == singlecell["col"])[0].tolist()
     tr_diag = np.where((singlecell["row"] + singlecell["col"]) == (number_of_channels - 1))[0].tolist()
     all_elem_ids = tl_diag + tr_diag
-    diag_mean = diag_sc["passed_filters"].mean()
 
     final_dataFrame = None
     # create 'adjust' column with reads to downsample
     if diag_mean > rows_limit:
         final_dataFrame = neighbors_reductions(
-            singlecell, all_elem_ids, degree, (row_mean / diag_mean), "diag"
+            singlecell,
+            all_elem_ids,
+            degree,
+            (row_mean / diag_mean),
+            "diag",
+            bad_elements,
+            decay,
         )
-        metrics_output["down"] = "TRUE"
+        metrics["down"] = "TRUE"
     elif diag_mean > cols_limit:
         final_dataFrame = neighbors_reductions(
-            singlecell, all_elem_ids, degree, (col_mean / diag_mean), "diag"
+            singlecell,
+            all_elem_ids,
+            degree,
+            (col_mean / diag_mean),
+            "diag",
+            bad_elements,
+            decay,
         )
-        metrics_output["down"] = "TRUE"
+        metrics["down"] = "TRUE"
     else:
         diag_sc["adjust"] = diag_sc["passed_filters"]
         final_dataFrame = diag_sc[["barcodes", "adjust"]]
-        metrics_output["down"] = "FALSE"
+        metrics["down"] = "FALSE"
 
     return final_dataFrame
 
 
 def combine_tables(
-    singlecell: pd.DataFrame, deviations: int = 1, degree: int = 1
-) -> pd.DataFrame:
+    singlecell: pd.DataFrame,
+    channels: int,
+    deviations: float = 1,
+    degree: int = 1,
+    metrics: Dict = None,
+    bad_elements: TixelMask = None,
+    lane_stats: LaneStats = None,
+    decay: float = DISTANCE_DECAY,
+) -> Dict[str, float]:
+    """Return the reduction table {barcode: target fragments} of all
+    outlier rows, columns and diagonals; outlier lanes are recorded in
+    metrics and their tixels in bad_elements.
+    """
+
+    if metrics is None:
+        metrics = {}
     row_singlecell = singlecell.copy()
     col_singlecell = singlecell.copy()
     dia_singlecell = singlecell.copy()
-    row_reductions = get_reductions(row_singlecell, "row", deviations, degree)
-    col_reductions = get_reductions(col_singlecell, "col", deviations, degree)
-    diag_reductions = get_diag_reductions(dia_singlecell, deviations, degree)
+
+    # Tixels in outlier lanes, excluded as neighbors from later reductions
+    if bad_elements is None:
+        bad_elements = TixelMask(channels)
+    if lane_stats is None:
+        lane_stats = get_lane_stats(singlecell, channels)
+    row_reductions = get_reductions(
+        row_singlecell,
+        "row",
+        deviations,
+        degree,
+        bad_elements,
+        metrics,
+        lane_stats,
+        decay,
+    )
+    col_reductions = get_reductions(
+        col_singlecell,
+        "col",
+        deviations,
+        degree,
+        bad_elements,
+        metrics,
+        lane_stats,
+        decay,
+    )
+    diag_reductions = get_diag_reductions(
+        dia_singlecell,
+        deviations,
+        degree,
+        bad_elements,
+        metrics,
+        lane_stats,
+        decay,
+    )
 
     # Concat rows and columns, if a tixel occurs twice, take the average value
     combined_table = average_duplicates(
@@ -317,66 +852,1715 @@ def combine_tables(
     return combined_table
 
 
-def clean_fragments(fragments_path: str, r_table: Dict[str, float]) -> pd.DataFrame:
+@dataclass
+class ReductionTable:
+    """Everything the fragments pass needs from the singlecell side of a
+    run: the reduction table, the outlier lanes for the metrics, the lane
+    statistics and flagged tixels they came from, and the passed_filters
+    of every tixel.  Saved as a small JSON artifact, so fragments can be
+    cleaned again without recomputing it.
+    """
+
+    reductions: Dict[str, float]
+    lanes: Dict[str, str]
+    lane_stats: LaneStats
+    mask: TixelMask
+    barcode_counts: Dict[str, int]
+    deviations: float
+    degree: int
+    decay: float = DISTANCE_DECAY
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "deviations": self.deviations,
+                    "degree": self.degree,
+                    "decay": self.decay,
+                    "channels": self.mask.channels,
+                    "lanes": self.lanes,
+                    "lane_stats": self.lane_stats.to_dict(),
+                    "mask": np.argwhere(self.mask.grid).tolist(),
+                    "reductions": self.reductions,
+                    "barcode_counts": self.barcode_counts,
+                },
+                f,
+            )
+
+    @classmethod
+    def read(cls, path: str) -> "ReductionTable":
+        with open(path) as f:
+            artifact = json.load(f)
+        mask = TixelMask(artifact["channels"])
+        if len(artifact["mask"]) > 0:
+            mask.add(*zip(*artifact["mask"]))
+        return cls(
+            reductions=artifact["reductions"],
+            lanes=artifact["lanes"],
+            lane_stats=LaneStats.from_dict(artifact["lane_stats"]),
+            mask=mask,
+            barcode_counts=artifact["barcode_counts"],
+            deviations=artifact["deviations"],
+            degree=artifact["degree"],
+            decay=artifact.get("decay", DISTANCE_DECAY),
+        )
+
+    def projected_final(self, total: int) -> int:
+        """Fragments left out of total after downsampling, from the
+        passed_filters counts of the outlier barcodes.
+        """
+
+        removed = sum(
+            max(0, self.barcode_counts.get(barcode, 0) - math.floor(target))
+            for barcode, target in self.reductions.items()
+        )
+        return total - removed
+
+
+def reduction_table(
+    singlecell: pd.DataFrame,
+    channels: int,
+    deviations: float = 1,
+    degree: int = 1,
+    lane_stats: LaneStats = None,
+    decay: float = DISTANCE_DECAY,
+    profile: StageProfile = None,
+) -> ReductionTable:
+    """Run combine_tables and keep everything it computed."""
+
+    if profile is None:
+        profile = StageProfile()
+    if lane_stats is None:
+        with profile.stage("lane_stats", len(singlecell)):
+            lane_stats = get_lane_stats(singlecell, channels)
+    lanes = {}
+    mask = TixelMask(channels)
+    with profile.stage("neighbor_reductions", len(singlecell)):
+        r_table = combine_tables(
+            singlecell,
+            channels,
+            deviations,
+            degree,
+            lanes,
+            mask,
+            lane_stats,
+            decay,
+        )
+    return ReductionTable(
+        reductions=r_table,
+        lanes=lanes,
+        lane_stats=lane_stats,
+        mask=mask,
+        barcode_counts={
+            barcode: int(count)
+            for barcode, count in passed_filters_counts(singlecell).items()
+        },
+        deviations=deviations,
+        degree=degree,
+        decay=decay,
+    )
+
+
+def singlecell_total(singlecell_path: str) -> int:
+    """Sum of passed_filters over all barcodes of a singlecell table, the
+    expected number of fragments in fragments.tsv.
+    """
+
+    singlecell = pd.read_csv(singlecell_path, usecols=[0, 2])
+    if singlecell.iloc[0, 0] == "NO_BARCODE":
+        singlecell = singlecell.drop(0, axis=0)
+    return int(singlecell.iloc[:, 1].sum())
+
+
+def write_sweep(filename: str, tables: List[ReductionTable], total: int):
+    """Write the outlier lanes and projected fragment counts of every
+    table of a sweep to a csv, one row per deviations.
+    """
+
+    with open(filename, "w") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(SWEEP_FIELDS)
+        for table in tables:
+            final = table.projected_final(total)
+            row = {
+                "deviations": table.deviations,
+                **table.lanes,
+                "og": total,
+                "final": final,
+                "pct": final / total,
+            }
+            writer.writerow([row.get(key) for key in SWEEP_KEYS])
+
+
+def clean_fragments(
+    fragments_path: str,
+    r_table: Dict[str, float],
+    seed: int = None,
+    metrics: Dict = None,
+) -> pd.DataFrame:
     """Reduce high tixels by randomly downsampling fragments.tsv
     according to reduction table.
     """
-    global metrics_output
+
+    if metrics is None:
+        metrics = {}
     logging.info("Loading fragments.tsv")
-    fragments = pd.read_csv(fragments_path, sep="\t", header=None, comment="#")
-    fragments.columns = ["V1", "V2", "V3", "barcodes", "V4"]
-    metrics_output["og"] = fragments.shape[0]
-    frag_copy = fragments.copy()
+    fragments = compact_fragments(
+        pd.read_csv(
+            fragments_path,
+            sep="\t",
+            header=None,
+            names=FRAGMENT_COLUMNS,
+            dtype=FRAGMENT_DTYPES,
+            comment="#",
+        )
+    )
+    metrics["og"] = fragments.shape[0]
     outlier_barcodes = list(r_table.keys())
 
     logging.info("Splitting fragments.tsv")
-    normal_frags = fragments[fragments["barcodes"].isin(outlier_barcodes) == False]
-    outlier_frags = frag_copy[frag_copy["barcodes"].isin(outlier_barcodes) == True]
+    is_outlier = (
+        barcode_lookup(fragments["barcodes"], pd.Index(outlier_barcodes)) >= 0
+    )
+    normal_frags = fragments[~is_outlier]
+    outlier_frags = fragments[is_outlier]
 
     # To each df in the list, randomly downsample if in reduction list
     logging.info("Downsampling....")
-    barcode_groups = outlier_frags.groupby("barcodes")
+    barcode_groups = outlier_frags.groupby("barcodes", observed=True)
+    rng = np.random.default_rng(seed)
     list_concat = []
     for i in outlier_barcodes:
         outlier = barcode_groups.get_group(i)
         if outlier.shape[0] > int(r_table[i]):
-            outlier = outlier.sample(n=math.floor(r_table[i]))
+            outlier = outlier.sample(
+                n=math.floor(r_table[i]), random_state=rng
+            )
         list_concat.append(outlier)
 
     downsampled_frags = pd.concat(list_concat)
     fragments_cleaned = pd.concat([downsampled_frags, normal_frags])
-    metrics_output["final"] = fragments_cleaned.shape[0]
-    metrics_output["pct"] = metrics_output["final"] / metrics_output["og"]
+    metrics["final"] = fragments_cleaned.shape[0]
+    metrics["pct"] = metrics["final"] / metrics["og"]
     return fragments_cleaned
 
 
-if __name__ == "__main__":
-    metrics_output = {}
+def read_fragments(
+    fragments_path: str,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    threads: int = None,
+    usecols: List[str] = None,
+) -> Iterator[pd.DataFrame]:
+    """Yield fragments.tsv(.gz) in chunks of at most chunksize rows; peak
+    memory is bounded by chunksize rather than by file size.  BGZF input
+    is inflated in parallel by read_bgzf_lines.
+    """
+
+    if (threads is None or threads > 1) and is_bgzf(fragments_path):
+        return (
+            parse_fragments(data, usecols)
+            for data in read_bgzf_lines(fragments_path, chunksize, threads)
+        )
+
+    chunks = pd.read_csv(
+        fragments_path,
+        sep="\t",
+        header=None,
+        names=FRAGMENT_COLUMNS,
+        dtype=FRAGMENT_DTYPES,
+        comment="#",
+        usecols=usecols,
+        chunksize=chunksize,
+    )
+    return (compact_fragments(chunk) for chunk in chunks)
+
+
+def parse_fragments(data: bytes, usecols: List[str] = None) -> pd.DataFrame:
+    """Parse whole lines of fragments.tsv into a DataFrame."""
+
+    fragments = pd.read_csv(
+        io.BytesIO(data),
+        sep="\t",
+        header=None,
+        names=FRAGMENT_COLUMNS,
+        dtype=FRAGMENT_DTYPES,
+        comment="#",
+        usecols=usecols,
+    )
+    return compact_fragments(fragments)
+
+
+def compact_fragments(fragments: pd.DataFrame) -> pd.DataFrame:
+    """Narrow the count column to uint16 when every count fits."""
+
+    if (
+        "V4" in fragments.columns
+        and fragments["V4"].to_numpy().max(initial=0)
+        <= np.iinfo(np.uint16).max
+    ):
+        fragments["V4"] = fragments["V4"].astype(np.uint16)
+    return fragments
+
+
+def concat_fragments(parts: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate fragment chunks, keeping the dictionary encoded
+    columns categorical when chunk dictionaries differ.
+    """
+
+    parts = [part for part in parts if part.shape[0] > 0] or parts[:1]
+    for column in ["V1", "barcodes"]:
+        if column not in parts[0].columns:
+            continue
+        categories = pd.api.types.union_categoricals(
+            [part[column] for part in parts], sort_categories=True
+        ).categories
+        for part in parts:
+            part[column] = part[column].cat.set_categories(categories)
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def barcode_lookup(barcodes: pd.Series, index: pd.Index) -> np.ndarray:
+    """Return the position in index of each barcode, -1 if absent.  For
+    dictionary encoded barcodes the lookup is done once per distinct
+    barcode and mapped through the integer codes.
+    """
+
+    if isinstance(barcodes.dtype, pd.CategoricalDtype):
+        positions = np.append(index.get_indexer(barcodes.cat.categories), -1)
+        return positions[barcodes.cat.codes.to_numpy()]
+    return index.get_indexer(barcodes)
+
+
+def count_barcodes(
+    fragments_path: str,
+    barcodes: List[str],
+    chunksize: int = DEFAULT_CHUNKSIZE,
+) -> Dict[str, int]:
+    """Cheap counting pre-pass; return the number of fragments in
+    fragments.tsv for each barcode in barcodes, reading only the barcode
+    column.
+    """
+
+    index = pd.Index(barcodes)
+    counts = np.zeros(len(index), dtype=np.int64)
+    chunks = read_fragments(fragments_path, chunksize, usecols=["barcodes"])
+    for chunk in chunks:
+        codes = barcode_lookup(chunk["barcodes"], index)
+        counts += np.bincount(codes[codes >= 0], minlength=len(index))
+
+    return dict(zip(index, counts.tolist()))
+
+
+class SelectionSampler:
+    """Single-pass downsampler for outlier barcodes.
+
+    Uses sequential selection sampling (each fragment of a barcode is kept
+    with probability remaining_needed/remaining_seen), so the number of
+    fragments kept per barcode is exact without ever materializing a
+    barcode's fragments.  Within a chunk the per-barcode draw is done at
+    once: the number kept is hypergeometric and the kept rows are a
+    uniform subset, which is equivalent to stepping through row by row.
+
+    Totals should be exact fragment counts; if a barcode turns out to
+    have more fragments than its total the total is raised to keep the
+    draw valid.  The fragments of every barcode of r_table are counted,
+    including those kept whole, and exact_counts() reports at the end
+    whether any count differs from its total.
+    """
+
+    def __init__(
+        self,
+        totals: Dict[str, int],
+        r_table: Dict[str, float],
+        seed: int = None,
+    ):
+        # Barcodes at or below their target are kept whole, as in
+        # clean_fragments; only barcodes above it need a sampler slot.
+        barcodes = [
+            b for b in r_table if totals.get(b, 0) > int(r_table[b])
+        ]
+        self.index = pd.Index(barcodes)
+        self.remaining_seen = np.array(
+            [totals[b] for b in barcodes], dtype=np.int64
+        )
+        self.remaining_needed = np.array(
+            [math.floor(r_table[b]) for b in barcodes], dtype=np.int64
+        )
+        self.keep_probability = dict(
+            zip(barcodes, self.remaining_needed / self.remaining_seen)
+        )
+        self.rng = np.random.default_rng(seed)
+
+        # Every barcode of r_table, with its total, the fragments seen and
+        # its sampler slot (-1 if kept whole)
+        self.tracked = pd.Index(list(r_table))
+        self.totals = np.array(
+            [totals.get(b, 0) for b in self.tracked], dtype=np.int64
+        )
+        self.seen = np.zeros(len(self.tracked), dtype=np.int64)
+        self.slots = np.full(len(self.tracked) + 1, -1, dtype=np.int64)
+        self.slots[self.tracked.get_indexer(self.index)] = np.arange(
+            len(self.index)
+        )
+
+    def exact_counts(self) -> bool:
+        """Return whether every total matched the fragments seen; only
+        meaningful once the whole file has passed through keep.
+        """
+
+        return bool((self.seen == self.totals).all())
+
+    def keep(self, barcodes: pd.Series) -> np.ndarray:
+        """Return boolean mask of fragments to keep from one chunk."""
+
+        keep = np.ones(len(barcodes), dtype=bool)
+        if len(self.tracked) == 0:
+            return keep
+        tracked_codes = barcode_lookup(barcodes, self.tracked)
+        self.seen += np.bincount(
+            tracked_codes[tracked_codes >= 0], minlength=len(self.tracked)
+        )
+        # -1 (untracked) maps to the last slot, which is -1
+        codes = self.slots[tracked_codes]
+        hits = np.flatnonzero(codes >= 0)
+        if hits.size == 0:
+            return keep
+        hit_codes = codes[hits]
+
+        in_chunk = np.bincount(hit_codes, minlength=len(self.index))
+        self.remaining_seen = np.maximum(self.remaining_seen, in_chunk)
+        present = np.flatnonzero(in_chunk)
+        picked = np.zeros(len(self.index), dtype=np.int64)
+        picked[present] = self.rng.hypergeometric(
+            self.remaining_needed[present],
+            self.remaining_seen[present] - self.remaining_needed[present],
+            in_chunk[present],
+        )
+
+        # Random rank of each fragment within its barcode; keep the first
+        # 'picked' of them.
+        order = np.lexsort((self.rng.random(hits.size), hit_codes))
+        sorted_codes = hit_codes[order]
+        rank = np.empty(hits.size, dtype=np.int64)
+        rank[order] = np.arange(hits.size) - np.searchsorted(
+            sorted_codes, sorted_codes
+        )
+        keep[hits] = rank < picked[hit_codes]
+
+        self.remaining_needed -= picked
+        self.remaining_seen -= in_chunk
+        return keep
+
+
+def passed_filters_counts(singlecell: pd.DataFrame) -> Dict[str, int]:
+    """Return passed_filters of each barcode of the singlecell table, for
+    use as SelectionSampler totals when passed_filters counts the rows of
+    fragments.tsv.
+    """
+
+    return dict(
+        zip(
+            singlecell["barcodes"],
+            singlecell["passed_filters"].astype(np.int64),
+        )
+    )
+
+
+def downsample_many(
+    fragments_path: str,
+    r_tables: List[Dict[str, float]],
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    seed: int = None,
+    barcode_counts: Dict[str, int] = None,
+    metrics: List[Dict] = None,
+    profile: StageProfile = None,
+) -> Iterator[List[pd.DataFrame]]:
+    """Downsample one read of fragments.tsv with several reduction tables
+    at once; yields, chunk by chunk, the fragments kept under each table.
+    Every table gets its own SelectionSampler seeded with seed, so each
+    output is the one downsample_fragments would give for that table.
+    Fragment counts are recorded in metrics[i] for table i.
+    """
+
+    if metrics is None:
+        metrics = [{} for _ in r_tables]
+    if profile is None:
+        profile = StageProfile()
+    barcodes = list(dict.fromkeys(b for r_table in r_tables for b in r_table))
+    file_size = os.path.getsize(fragments_path)
+
+    if barcode_counts is None and barcodes:
+        logging.info("Counting fragments per outlier barcode")
+        with profile.stage("count", nbytes=file_size):
+            barcode_counts = count_barcodes(
+                fragments_path, barcodes, chunksize
+            )
+    samplers = [
+        SelectionSampler(barcode_counts or {}, r_table, seed)
+        for r_table in r_tables
+    ]
+    for sampler, r_table in zip(samplers, r_tables):
+        logging.info(
+            f"{len(sampler.index)} of {len(r_table)} outlier barcodes are "
+            "above their target"
+        )
+
+    og_count = 0
+    final_counts = [0] * len(r_tables)
+
+    logging.info(f"Downsampling fragments.tsv in chunks of {chunksize} rows")
+    chunks = read_fragments(fragments_path, chunksize)
+    for chunk in profile.iterate("read", chunks):
+        og_count += chunk.shape[0]
+        with profile.stage("downsample", chunk.shape[0]):
+            kept = [
+                chunk[sampler.keep(chunk["barcodes"])] for sampler in samplers
+            ]
+        for i, part in enumerate(kept):
+            final_counts[i] += part.shape[0]
+        yield kept
+    profile.add("read", 0.0, 0.0, nbytes=file_size, calls=0)
+
+    for run_metrics, sampler in zip(metrics, samplers):
+        run_metrics["exact_counts"] = sampler.exact_counts()
+    if not all(sampler.exact_counts() for sampler in samplers):
+        logging.warning(
+            "Barcode counts did not match fragments.tsv; fragments kept for "
+            "some outlier barcodes differ from their targets."
+        )
+
+    for run_metrics, final_count in zip(metrics, final_counts):
+        run_metrics["og"] = og_count
+        run_metrics["final"] = final_count
+        run_metrics["pct"] = final_count / og_count
+
+
+def downsample_fragments(
+    fragments_path: str,
+    r_table: Dict[str, float],
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    seed: int = None,
+    barcode_counts: Dict[str, int] = None,
+    metrics: Dict = None,
+    profile: StageProfile = None,
+) -> Iterator[pd.DataFrame]:
+    """Yield fragments.tsv chunk by chunk with outlier barcodes
+    downsampled in the same pass by a SelectionSampler.  barcode_counts
+    should be exact fragment counts for the barcodes in r_table; if not
+    provided they are taken from a counting pre-pass.  Barcodes at or
+    below their target are passed through untouched, and if none are
+    above it the pass is a plain copy.  Fragment counts are recorded in
+    metrics once the file is exhausted.
+    """
+
+    if metrics is None:
+        metrics = {}
+
+    for (kept,) in downsample_many(
+        fragments_path,
+        [r_table],
+        chunksize,
+        seed,
+        barcode_counts,
+        [metrics],
+        profile,
+    ):
+        yield kept
+
+
+def fan_out(
+    rows: Iterator[List[pd.DataFrame]],
+    consumers: List[Callable[[Iterator[pd.DataFrame]], None]],
+    depth: int = 2,
+):
+    """Feed item i of every element of rows to consumers[i]; each consumer
+    runs in its own thread on a bounded queue, so rows is read once.
+    """
+
+    done = object()
+    queues = [queue.Queue(depth) for _ in consumers]
+
+    def drain(q: queue.Queue) -> Iterator[pd.DataFrame]:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            yield item
+
+    def put(q: queue.Queue, future, item):
+        while True:
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                if future.done():
+                    future.result()
+
+    def close(q: queue.Queue):
+        # without blocking: the consumer may have stopped reading
+        while True:
+            try:
+                q.put_nowait(done)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+    with ThreadPoolExecutor(len(consumers)) as pool:
+        futures = [
+            pool.submit(consumer, drain(q))
+            for consumer, q in zip(consumers, queues)
+        ]
+        finished = False
+        try:
+            for row in rows:
+                for q, future, item in zip(queues, futures, row):
+                    put(q, future, item)
+            for q, future in zip(queues, futures):
+                put(q, future, done)
+            finished = True
+        finally:
+            # on failure, stop the other consumers so that leaving the
+            # pool does not wait on them forever
+            if not finished:
+                for q in queues:
+                    close(q)
+        for future in futures:
+            future.result()
+
+
+class FragmentsParquet:
+    """Parquet copy of a fragments file as it is written, for loaders
+    that should not parse tsv.  Chromosomes and barcodes are dictionary
+    encoded, and consecutive fragments of a chromosome are buffered so
+    every row group holds a single chromosome.  Needs pyarrow, which is
+    only imported when a FragmentsParquet is made.
+    """
+
+    def __init__(
+        self, path: str, row_group_rows: int = PARQUET_ROW_GROUP_ROWS
+    ):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.path = path
+        self.row_group_rows = row_group_rows
+        self.schema = pa.schema(
+            [
+                ("chrom", pa.dictionary(pa.int32(), pa.string())),
+                ("start", pa.uint32()),
+                ("end", pa.uint32()),
+                ("barcode", pa.dictionary(pa.int32(), pa.string())),
+                ("count", pa.uint32()),
+            ]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.chrom = None
+        self.parts = []
+        self.rows = 0
+
+    def _table(self, fragments: pd.DataFrame):
+        arrays = []
+        for column, field in zip(FRAGMENT_COLUMNS, self.schema):
+            values = fragments[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                array = self.pa.DictionaryArray.from_arrays(
+                    values.cat.codes.to_numpy(dtype=np.int32),
+                    self.pa.array(values.cat.categories, self.pa.string()),
+                )
+            elif self.pa.types.is_dictionary(field.type):
+                array = self.pa.array(values.astype(str)).dictionary_encode()
+            else:
+                array = self.pa.array(values.to_numpy(), field.type)
+            arrays.append(array.cast(field.type))
+        return self.pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def add(self, fragments: pd.DataFrame):
+        """Append fragments, which are in output order."""
+
+        chroms = fragments["V1"].to_numpy()
+        change = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        bounds = np.concatenate([[0], change, [len(chroms)]]).tolist()
+        for first, last in zip(bounds, bounds[1:]):
+            if chroms[first] != self.chrom:
+                self.flush()
+                self.chrom = chroms[first]
+            self.parts.append(self._table(fragments.iloc[first:last]))
+            self.rows += last - first
+            if self.rows >= self.row_group_rows:
+                self.flush()
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        table = self.pa.concat_tables(self.parts)
+        self.writer.write_table(table, row_group_size=self.row_group_rows)
+        self.parts = []
+        self.rows = 0
+
+    def append_file(self, path: str):
+        """Append the row groups of another FragmentsParquet file."""
+
+        import pyarrow.parquet as pq
+
+        self.flush()
+        self.chrom = None
+        shard = pq.ParquetFile(path)
+        for i in range(shard.num_row_groups):
+            table = shard.read_row_group(i)
+            self.writer.write_table(table, row_group_size=table.num_rows)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def parquet_copy(parquet_path: str) -> FragmentsParquet:
+    """FragmentsParquet writing to parquet_path, or None without one."""
+
+    return FragmentsParquet(parquet_path) if parquet_path else None
+
+
+def version_key(name: str) -> List:
+    """Sort key equivalent to 'sort -V' for chromosome names."""
+
+    return [
+        int(part) if part.isdigit() else part
+        for part in re.split(r"(\d+)", name)
+    ]
+
+
+def write_fragments(
+    fragments: pd.DataFrame, out: BgzfWriter, chunksize: int
+):
+    """Format fragments as tsv and write them to out, chunksize rows at
+    a time, and to out's Parquet copy if it has one; timed as the write
+    and parquet stages if out has a profile.
+    """
+
+    profile = out.profile or StageProfile()
+    for start in range(0, fragments.shape[0], chunksize):
+        batch = fragments.iloc[start : start + chunksize]
+        with profile.stage("write", batch.shape[0]) as counts:
+            data = batch.to_csv(sep="\t", index=False, header=False).encode()
+            counts["bytes"] = len(data)
+            if out.index is not None:
+                out.index.add(
+                    batch["V1"].to_numpy(),
+                    batch["V2"].to_numpy(),
+                    batch["V3"].to_numpy(),
+                    out.offset,
+                    data,
+                )
+                out.barcode_index.add(
+                    batch["V1"],
+                    batch["V2"],
+                    batch["barcodes"],
+                    out.offset,
+                    data,
+                )
+            out.write(data)
+        if out.columnar is not None:
+            with profile.stage("parquet", batch.shape[0]):
+                out.columnar.add(batch)
+
+
+def sort_to_bgzf(
+    chunks: Iterable[pd.DataFrame],
+    out_path: str,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    tmp_dir: str = None,
+    profile: StageProfile = None,
+    parquet_path: str = None,
+):
+    """Write fragments sorted by chromosome (version order) and start to
+    a BGZF file, and to parquet_path if given.  Chunks are spilled to one
+    binary file per chromosome, so at most one chromosome is held in
+    memory while sorting.
+    """
+
+    if profile is None:
+        profile = StageProfile()
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+        spill_files = {}
+        for chunk in chunks:
+            with profile.stage("spill", chunk.shape[0]):
+                for chrom, part in chunk.groupby(
+                    "V1", sort=False, observed=True
+                ):
+                    if chrom not in spill_files:
+                        spill_files[chrom] = os.path.join(
+                            spill_dir, f"{len(spill_files)}.pkl"
+                        )
+                    with open(spill_files[chrom], "ab") as spill:
+                        pickle.dump(part, spill, pickle.HIGHEST_PROTOCOL)
+
+        logging.info("Sorting and compressing fragments")
+        with BgzfWriter(
+            out_path,
+            index=True,
+            profile=profile,
+            columnar=parquet_copy(parquet_path),
+        ) as out:
+            for chrom in sorted(spill_files, key=version_key):
+                with profile.stage("sort") as counts:
+                    parts = []
+                    with open(spill_files[chrom], "rb") as spill:
+                        while True:
+                            try:
+                                parts.append(pickle.load(spill))
+                            except EOFError:
+                                break
+                    os.remove(spill_files[chrom])
+                    fragments = concat_fragments(parts).sort_values(
+                        ["V2", "V3", "barcodes"], kind="stable"
+                    )
+                    del parts
+                    counts["rows"] = fragments.shape[0]
+                write_fragments(fragments, out, chunksize)
+
+
+class SortChecker:
+    """Track whether consecutive fragment chunks are coordinate sorted:
+    every chromosome in one contiguous block and starts non-decreasing
+    within it.
+    """
+
+    def __init__(self):
+        self.finished = set()
+        self.chrom = None
+        self.start = -1
+        self.runs = []  # [chrom, first start, last start] of each block
+
+    def check(self, chunk: pd.DataFrame) -> bool:
+        if chunk.shape[0] == 0:
+            return True
+        chroms = chunk["V1"].to_numpy()
+        starts = chunk["V2"].to_numpy(dtype=np.int64)
+
+        change = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        blocks = chroms[np.concatenate([[0], change])].tolist()
+        closed = set(self.finished)
+        if blocks[0] == self.chrom:
+            if starts[0] < self.start:
+                return False
+        elif self.chrom is not None:
+            closed.add(self.chrom)
+        if len(set(blocks)) != len(blocks) or closed.intersection(blocks):
+            return False
+
+        steps = np.diff(starts) >= 0
+        steps[change - 1] = True
+        if not steps.all():
+            return False
+
+        run_starts = np.concatenate([[0], change])
+        run_ends = np.concatenate([change, [len(chroms)]]) - 1
+        for chrom, first, last in zip(
+            blocks, starts[run_starts].tolist(), starts[run_ends].tolist()
+        ):
+            if self.runs and self.runs[-1][0] == chrom:
+                self.runs[-1][2] = last
+            else:
+                self.runs.append([chrom, first, last])
+
+        self.finished = closed.union(blocks[:-1])
+        self.chrom = blocks[-1]
+        self.start = starts[-1]
+        return True
+
+
+def write_preserving_order(
+    chunks: Iterable[pd.DataFrame],
+    out_path: str,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    tmp_dir: str = None,
+    profile: StageProfile = None,
+    parquet_path: str = None,
+) -> bool:
+    """Write chunks to a BGZF file (and to parquet_path if given) in
+    their original order, skipping the sort, while the input is
+    coordinate sorted.  If a chunk out of order is found, what was
+    written so far and the remaining chunks are passed through
+    sort_to_bgzf instead.  Returns whether the input was sorted.
+    """
+
+    checker = SortChecker()
+    chunks = iter(chunks)
+    with BgzfWriter(
+        out_path,
+        index=True,
+        profile=profile,
+        columnar=parquet_copy(parquet_path),
+    ) as out:
+        for chunk in chunks:
+            if not checker.check(chunk):
+                break
+            write_fragments(chunk, out, chunksize)
+        else:
+            return True
+
+    logging.info("Input fragments are not sorted, sorting output")
+    out_dir, out_name = os.path.split(out_path)
+    partial_path = os.path.join(out_dir, f"partial_{out_name}")
+    os.replace(out_path, partial_path)
+    remaining = itertools.chain(
+        read_fragments(partial_path, chunksize), [chunk], chunks
+    )
+    sort_to_bgzf(
+        remaining, out_path, chunksize, tmp_dir, profile, parquet_path
+    )
+    os.remove(partial_path)
+    return False
+
+
+def count_shard(
+    fragments_path: str,
+    start: int,
+    end: int,
+    barcodes: List[str],
+    chunksize: int = DEFAULT_CHUNKSIZE,
+) -> Tuple[np.ndarray, Dict[str, dict]]:
+    """Count fragments of each of barcodes in one block range of a BGZF
+    fragments file.  Returns the counts and the stages of the shard's
+    profile.
+    """
+
+    profile = StageProfile()
+    index = pd.Index(barcodes)
+    counts = np.zeros(len(index), dtype=np.int64)
+    with profile.stage("count") as stage_counts:
+        for data in read_bgzf_lines(fragments_path, chunksize, 1, start, end):
+            chunk = parse_fragments(data, usecols=["barcodes"])
+            codes = barcode_lookup(chunk["barcodes"], index)
+            counts += np.bincount(codes[codes >= 0], minlength=len(index))
+            stage_counts["rows"] += chunk.shape[0]
+
+    return counts, profile.stages
+
+
+def clean_shard(
+    fragments_path: str,
+    start: int,
+    end: int,
+    out_path: str,
+    totals: Dict[str, int],
+    quotas: Dict[str, int],
+    seed: np.random.SeedSequence,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    parquet_path: str = None,
+) -> dict:
+    """Downsample one block range of a BGZF fragments file to the given
+    per-barcode quotas and write it as a BGZF shard without EOF block,
+    and as a Parquet shard to parquet_path if given.  Returns what is
+    needed to join the shards: block offsets, tabix index, fragment
+    counts, the sortedness of the shard and the stages of its profile.
+    """
+
+    profile = StageProfile()
+    sampler = SelectionSampler(totals, quotas, seed)
+    checker = SortChecker()
+    is_sorted = True
+    og_count = 0
+    final_count = 0
+    with BgzfWriter(
+        out_path,
+        threads=1,
+        index=True,
+        eof=False,
+        profile=profile,
+        columnar=parquet_copy(parquet_path),
+    ) as out:
+        chunks = (
+            parse_fragments(data)
+            for data in read_bgzf_lines(
+                fragments_path, chunksize, 1, start, end
+            )
+        )
+        for chunk in profile.iterate("read", chunks):
+            og_count += chunk.shape[0]
+            with profile.stage("downsample", chunk.shape[0]):
+                kept = chunk[sampler.keep(chunk["barcodes"])]
+            final_count += kept.shape[0]
+            is_sorted = is_sorted and checker.check(kept)
+            write_fragments(kept, out, chunksize)
+
+    return {
+        "blocks": out.blocks,
+        "index": out.index,
+        "barcode_index": out.barcode_index,
+        "size": out.emitted,
+        "og": og_count,
+        "final": final_count,
+        "sorted": is_sorted,
+        "runs": checker.runs,
+        "stages": profile.stages,
+    }
+
+
+def split_quotas(
+    r_table: Dict[str, float],
+    shard_counts: np.ndarray,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Split the target of each barcode of r_table across shards, given
+    its fragment count in each shard (shards x barcodes).  The split is
+    multivariate hypergeometric, so the union of per-shard uniform samples
+    is a uniform sample of the barcode's fragments and totals are exact.
+    """
+
+    quotas = shard_counts.copy()
+    for i, barcode in enumerate(r_table):
+        total = int(shard_counts[:, i].sum())
+        if total > int(r_table[barcode]):
+            quotas[:, i] = rng.multivariate_hypergeometric(
+                shard_counts[:, i], math.floor(r_table[barcode])
+            )
+
+    return quotas
+
+
+def shard_clean_fragments(
+    fragments_path: str,
+    r_table: Dict[str, float],
+    out_path: str,
+    processes: int,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    seed: int = None,
+    tmp_dir: str = None,
+    metrics: Dict = None,
+    parquet_path: str = None,
+    profile: StageProfile = None,
+) -> bool:
+    """Clean a BGZF fragments file on a process pool.  The file is split
+    into processes ranges of whole BGZF blocks; shards are counted, each
+    barcode's target is split exactly across shards, and shards are then
+    downsampled and compressed in parallel and joined in file order, with
+    their tabix indexes merged.  If the joined output is not coordinate
+    sorted it is sorted with sort_to_bgzf.  With parquet_path, shards
+    also write Parquet copies, joined the same way.  Fragment counts are
+    recorded in metrics and the stages of every shard are merged into
+    profile.  Returns whether the input was sorted.
+    """
+
+    if metrics is None:
+        metrics = {}
+    if profile is None:
+        profile = StageProfile()
+
+    offsets = bgzf_block_offsets(fragments_path)
+    step = max(1, math.ceil(len(offsets) / processes))
+    starts = offsets[::step]
+    ranges = list(zip(starts, starts[1:] + [None]))
+    barcodes = list(r_table.keys())
+    seeds = np.random.SeedSequence(seed).spawn(len(ranges) + 1)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as shard_dir:
+        shard_parquets = [
+            None
+            if parquet_path is None
+            else os.path.join(shard_dir, f"{i}.parquet")
+            for i in range(len(ranges))
+        ]
+        with ProcessPoolExecutor(processes) as pool:
+            logging.info(f"Counting outlier barcodes in {len(ranges)} shards")
+            futures = [
+                pool.submit(
+                    count_shard, fragments_path, a, b, barcodes, chunksize
+                )
+                for a, b in ranges
+            ]
+            shard_counts = []
+            for future in futures:
+                counts, stages = future.result()
+                shard_counts.append(counts)
+                profile.merge(stages)
+            shard_counts = np.array(shard_counts).reshape(
+                len(ranges), len(barcodes)
+            )
+            quotas = split_quotas(
+                r_table, shard_counts, np.random.default_rng(seeds[-1])
+            )
+
+            logging.info(f"Downsampling {len(ranges)} shards")
+            futures = [
+                pool.submit(
+                    clean_shard,
+                    fragments_path,
+                    a,
+                    b,
+                    os.path.join(shard_dir, f"{i}.bgz"),
+                    dict(zip(barcodes, shard_counts[i].tolist())),
+                    dict(zip(barcodes, quotas[i].tolist())),
+                    seeds[i],
+                    chunksize,
+                    shard_parquets[i],
+                )
+                for i, (a, b) in enumerate(ranges)
+            ]
+            shards = [future.result() for future in futures]
+            for shard in shards:
+                profile.merge(shard["stages"])
+
+        # Join shards in file order, shifting their offsets
+        checker = SortChecker()
+        is_sorted = True
+        index = TabixIndex()
+        barcode_index = BarcodeBlockIndex()
+        blocks = []
+        u_shift = 0
+        with open(out_path, "wb") as out:
+            for i, shard in enumerate(shards):
+                c_shift = out.tell()
+                barcode_index.extend(shard["barcode_index"], len(blocks))
+                blocks += [
+                    (u + u_shift, c + c_shift)
+                    for u, c in shard["blocks"][:-1]
+                ]
+                index.extend(shard["index"], u_shift)
+                u_shift += shard["size"]
+                with open(os.path.join(shard_dir, f"{i}.bgz"), "rb") as part:
+                    shutil.copyfileobj(part, out)
+
+                boundaries = pd.DataFrame(
+                    [
+                        [chrom, position]
+                        for chrom, first, last in shard["runs"]
+                        for position in (first, last)
+                    ],
+                    columns=["V1", "V2"],
+                )
+                is_sorted = (
+                    is_sorted and shard["sorted"] and checker.check(boundaries)
+                )
+            blocks.append((u_shift, out.tell()))
+            out.write(BGZF_EOF)
+
+        if is_sorted and parquet_path is not None:
+            columnar = FragmentsParquet(parquet_path)
+            for shard_path in shard_parquets:
+                columnar.append_file(shard_path)
+            columnar.close()
+
+    metrics["og"] = sum(shard["og"] for shard in shards)
+    metrics["final"] = sum(shard["final"] for shard in shards)
+    metrics["pct"] = metrics["final"] / metrics["og"]
+
+    if is_sorted:
+        if index.refs:
+            index.write(f"{out_path}.tbi", blocks)
+            barcode_index.write(f"{out_path}.bci", blocks)
+        return True
+
+    logging.info("Input fragments are not sorted, sorting output")
+    out_dir, out_name = os.path.split(out_path)
+    partial_path = os.path.join(out_dir, f"partial_{out_name}")
+    os.replace(out_path, partial_path)
+    sort_to_bgzf(
+        read_fragments(partial_path, chunksize),
+        out_path,
+        chunksize,
+        tmp_dir,
+        profile,
+        parquet_path,
+    )
+    os.remove(partial_path)
+    return False
+
+
+def estimate_peak_memory(
+    fragments_bytes: int,
+    singlecell_bytes: int = 0,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+) -> int:
+    """Upper estimate of the peak RSS in bytes of cleaning one sample
+    from the sizes of its gzipped fragments file and singlecell csv,
+    assuming the input may need sorting.
+    """
+
+    fragments = fragments_bytes / GZIP_BYTES_PER_FRAGMENT
+    return int(
+        MEMORY_BASE
+        + MEMORY_PER_CHUNK_ROW * min(chunksize, fragments)
+        + MEMORY_PER_SORTED_ROW * LARGEST_CHROMOSOME_SHARE * fragments
+        + MEMORY_PER_SINGLECELL_BYTE * singlecell_bytes
+    )
+
+
+def write_metrics(filename: str, metrics: Dict):
+    """Write cleaning metrics to a one-row csv."""
+
+    with open(filename, "w") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(METRICS_FIELDS)
+        writer.writerow([metrics.get(key) for key in METRICS_KEYS])
+
+
+def read_metrics(filename: str) -> Dict:
+    """Read a metrics csv written by write_metrics."""
+
+    with open(filename) as csvfile:
+        row = next(csv.DictReader(csvfile))
+    metrics = {
+        key: row[field] for key, field in zip(METRICS_KEYS, METRICS_FIELDS)
+    }
+    metrics["og"] = int(metrics["og"])
+    metrics["final"] = int(metrics["final"])
+    metrics["pct"] = float(metrics["pct"])
+    return metrics
+
+
+@dataclass
+class CleaningResult:
+    run_id: str
+    reductions: Dict[str, float]
+    metrics: Dict
+    fragments_file: str
+    metrics_file: str
+    profile: StageProfile = None
+    profile_file: str = None
+    parquet_file: str = None
+
+
+class Cleaner:
+    """Cleaning pipeline with its parameters; all state of a run is
+    local to the call, so one Cleaner can clean many samples, from
+    several threads or processes at once.  The positions files it parses
+    are kept in its GridCache; pass grids to share one between Cleaners.
+
+    With preserve_order, fragments are kept in input order and the sort
+    is skipped if the input is already coordinate sorted.  With
+    trust_passed_filters, per-barcode totals come from the singlecell
+    table instead of a counting pre-pass over fragments.tsv; apply and
+    apply_many check them during the pass and clean again with counted
+    totals if they don't match the fragments.  With processes > 1 and
+    BGZF input, the fragments pass is sharded across a process pool
+    (shard_clean_fragments); sharded runs always count, as the quotas
+    are split by per-shard counts, and ignore trust_passed_filters.
+    degree and decay set the neighborhood outlier tixels are reduced to
+    (see DISTANCE_DECAY).
+    With parquet, the cleaned fragments are also written as Parquet
+    (FragmentsParquet, needs pyarrow).
+    """
+
+    def __init__(
+        self,
+        deviations: float = 1,
+        degree: int = 1,
+        chunksize: int = DEFAULT_CHUNKSIZE,
+        seed: int = None,
+        preserve_order: bool = True,
+        trust_passed_filters: bool = False,
+        processes: int = 1,
+        decay: float = DISTANCE_DECAY,
+        parquet: bool = False,
+        grids: GridCache = None,
+    ):
+        self.deviations = deviations
+        self.degree = degree
+        self.decay = decay
+        self.chunksize = chunksize
+        self.seed = seed
+        self.preserve_order = preserve_order
+        self.trust_passed_filters = trust_passed_filters
+        self.processes = processes
+        self.parquet = parquet
+        self.grids = grids if grids is not None else GridCache()
+
+    def parquet_path(self, out_dir: str, run_id: str) -> str:
+        if not self.parquet:
+            return None
+        return os.path.join(out_dir, f"cleaned_{run_id}_fragments.parquet")
+
+    def reductions(
+        self,
+        singlecell_path: str,
+        position_path: str,
+        profile: StageProfile = None,
+    ) -> ReductionTable:
+        """Compute the reduction table of a sample from its singlecell and
+        positions files.
+        """
+
+        if profile is None:
+            profile = StageProfile()
+        with profile.stage("filter_sc") as counts:
+            singlecell, channels = filter_sc(
+                singlecell_path, position_path, self.grids
+            )
+            counts["rows"] = len(singlecell)
+            counts["bytes"] = os.path.getsize(singlecell_path)
+        return reduction_table(
+            singlecell,
+            channels,
+            self.deviations,
+            self.degree,
+            decay=self.decay,
+            profile=profile,
+        )
+
+    def sweep(
+        self,
+        singlecell_path: str,
+        position_path: str,
+        deviations: List[float],
+    ) -> List[ReductionTable]:
+        """Compute the reduction table for each of several deviations,
+        sharing the singlecell parsing and the lane statistics.
+        """
+
+        singlecell, channels = filter_sc(
+            singlecell_path, position_path, self.grids
+        )
+        lane_stats = get_lane_stats(singlecell, channels)
+        return [
+            reduction_table(
+                singlecell,
+                channels,
+                deviation,
+                self.degree,
+                lane_stats,
+                self.decay,
+            )
+            for deviation in deviations
+        ]
+
+    def clean(
+        self,
+        run_id: str,
+        singlecell_path: str,
+        position_path: str,
+        fragments_path: str,
+        out_dir: str = ".",
+    ) -> CleaningResult:
+        """Compute the reduction table, downsample fragments and write
+        them sorted and BGZF compressed to out_dir, with the metrics csv,
+        the reduction table artifact and the stage profile.
+        """
+
+        profile = StageProfile()
+        table = self.reductions(singlecell_path, position_path, profile)
+        os.makedirs(out_dir, exist_ok=True)
+        table.write(os.path.join(out_dir, f"{run_id}_reductions.json"))
+
+        return self.apply(run_id, table, fragments_path, out_dir, profile)
+
+    def apply(
+        self,
+        run_id: str,
+        table: ReductionTable,
+        fragments_path: str,
+        out_dir: str = ".",
+        profile: StageProfile = None,
+    ) -> CleaningResult:
+        """Downsample fragments with an existing reduction table and write
+        them sorted and BGZF compressed to out_dir, with the metrics csv
+        and the stage profile ({run_id}_profile.json).
+        """
+
+        if profile is None:
+            profile = StageProfile()
+        metrics = {"run_id": run_id, **table.lanes}
+        os.makedirs(out_dir, exist_ok=True)
+        out_file = os.path.join(out_dir, f"cleaned_{run_id}_fragments.tsv.gz")
+        out_metrics = os.path.join(out_dir, f"{run_id}_cleaning_metrics.csv")
+        out_profile = os.path.join(out_dir, f"{run_id}_profile.json")
+        out_parquet = self.parquet_path(out_dir, run_id)
+
+        r_table = table.reductions
+        if self.processes > 1 and is_bgzf(fragments_path):
+            # the shards' stages are merged into profile; shard times the
+            # whole pass
+            size = os.path.getsize(fragments_path)
+            with profile.stage("shard", nbytes=size):
+                shard_clean_fragments(
+                    fragments_path,
+                    r_table,
+                    out_file,
+                    self.processes,
+                    self.chunksize,
+                    self.seed,
+                    tmp_dir=out_dir,
+                    metrics=metrics,
+                    parquet_path=out_parquet,
+                    profile=profile,
+                )
+        else:
+            barcode_counts = (
+                table.barcode_counts if self.trust_passed_filters else None
+            )
+            chunks = downsample_fragments(
+                fragments_path,
+                r_table,
+                self.chunksize,
+                self.seed,
+                barcode_counts,
+                metrics,
+                profile,
+            )
+            write = (
+                write_preserving_order if self.preserve_order else sort_to_bgzf
+            )
+            write(
+                chunks, out_file, self.chunksize, out_dir, profile, out_parquet
+            )
+            if barcode_counts is not None and not metrics["exact_counts"]:
+                # passed_filters did not count the rows of fragments.tsv;
+                # the output is redone with counted totals
+                logging.info("Cleaning again with counted barcode totals")
+                chunks = downsample_fragments(
+                    fragments_path,
+                    r_table,
+                    self.chunksize,
+                    self.seed,
+                    None,
+                    metrics,
+                    profile,
+                )
+                write(
+                    chunks,
+                    out_file,
+                    self.chunksize,
+                    out_dir,
+                    profile,
+                    out_parquet,
+                )
+        write_metrics(out_metrics, metrics)
+        profile.write(out_profile)
+
+        return CleaningResult(
+            run_id=run_id,
+            reductions=r_table,
+            metrics=metrics,
+            fragments_file=out_file,
+            metrics_file=out_metrics,
+            profile=profile,
+            profile_file=out_profile,
+            parquet_file=out_parquet,
+        )
+
+    def update(
+        self,
+        run_id: str,
+        table: ReductionTable,
+        previous_dir: str,
+        fragments_path: str = None,
+        out_dir: str = ".",
+    ) -> CleaningResult:
+        """Re-clean the output of an earlier run in previous_dir with a
+        new reduction table, rewriting only the blocks of the barcodes
+        whose count changes (update_fragments); fragments_path is needed
+        when targets are raised.  Falls back to apply when the previous
+        output has no barcode index, when Parquet output is requested or
+        when the change can't be made in place.
+
+        Lowering targets only reads the blocks of the lowered barcodes.
+        Raising any target also reads the whole of fragments_path once,
+        in chunks, and holds the kept fragments of the raised barcodes and
+        the fragments they gain; the original file has no index to read
+        only their fragments from.
+        """
+
+        profile = StageProfile()
+        previous_file = os.path.join(
+            previous_dir, f"cleaned_{run_id}_fragments.tsv.gz"
+        )
+        out_file = os.path.join(out_dir, f"cleaned_{run_id}_fragments.tsv.gz")
+        out_metrics = os.path.join(out_dir, f"{run_id}_cleaning_metrics.csv")
+        out_profile = os.path.join(out_dir, f"{run_id}_profile.json")
+        if os.path.abspath(out_file) == os.path.abspath(previous_file):
+            raise ValueError("out_dir must differ from previous_dir.")
+        previous = ReductionTable.read(
+            os.path.join(previous_dir, f"{run_id}_reductions.json")
+        )
+        os.makedirs(out_dir, exist_ok=True)
+        table.write(os.path.join(out_dir, f"{run_id}_reductions.json"))
+
+        # update imports the engine, so it is only imported here
+        if __package__:
+            from .update import update_fragments
+        else:
+            from update import update_fragments
+
+        changes = None
+        if not self.parquet and os.path.exists(f"{previous_file}.bci"):
+            changes = update_fragments(
+                previous_file,
+                previous.reductions,
+                table.reductions,
+                out_file,
+                fragments_path,
+                self.chunksize,
+                self.seed,
+                profile,
+            )
+        if changes is None:
+            if fragments_path is None:
+                raise ValueError(
+                    "The previous output can't be updated in place; "
+                    "cleaning again needs the original fragments file."
+                )
+            logging.info("Cleaning the original fragments again")
+            return self.apply(run_id, table, fragments_path, out_dir, profile)
+
+        previous_metrics = read_metrics(
+            os.path.join(previous_dir, f"{run_id}_cleaning_metrics.csv")
+        )
+        metrics = {"run_id": run_id, **table.lanes}
+        metrics["og"] = previous_metrics["og"]
+        metrics["final"] = (
+            previous_metrics["final"] - changes["dropped"] + changes["added"]
+        )
+        metrics["pct"] = metrics["final"] / metrics["og"]
+        write_metrics(out_metrics, metrics)
+        profile.write(out_profile)
+
+        return CleaningResult(
+            run_id=run_id,
+            reductions=table.reductions,
+            metrics=metrics,
+            fragments_file=out_file,
+            metrics_file=out_metrics,
+            profile=profile,
+            profile_file=out_profile,
+        )
+
+    def apply_many(
+        self,
+        run_id: str,
+        tables: List[ReductionTable],
+        fragments_path: str,
+        out_dir: str = ".",
+    ) -> List[CleaningResult]:
+        """Clean fragments with every table in one shared read; table i is
+        written to {out_dir}/deviations_{d}/ with its metrics csv and
+        artifact.  The read is not sharded.
+        """
+
+        out_dirs = [
+            os.path.join(out_dir, f"deviations_{table.deviations:g}")
+            for table in tables
+        ]
+        metrics = [{"run_id": run_id, **table.lanes} for table in tables]
+        results = []
+        for table, table_dir, table_metrics in zip(tables, out_dirs, metrics):
+            os.makedirs(table_dir, exist_ok=True)
+            table.write(os.path.join(table_dir, f"{run_id}_reductions.json"))
+            results.append(
+                CleaningResult(
+                    run_id=run_id,
+                    reductions=table.reductions,
+                    metrics=table_metrics,
+                    fragments_file=os.path.join(
+                        table_dir, f"cleaned_{run_id}_fragments.tsv.gz"
+                    ),
+                    metrics_file=os.path.join(
+                        table_dir, f"{run_id}_cleaning_metrics.csv"
+                    ),
+                    parquet_file=self.parquet_path(table_dir, run_id),
+                )
+            )
+
+        profile = StageProfile()
+        write = (
+            write_preserving_order if self.preserve_order else sort_to_bgzf
+        )
+
+        def writer(result: CleaningResult, tmp_dir: str):
+            return lambda chunks: write(
+                chunks,
+                result.fragments_file,
+                self.chunksize,
+                tmp_dir,
+                profile,
+                result.parquet_file,
+            )
+
+        def clean(barcode_counts: Dict[str, int]):
+            rows = downsample_many(
+                fragments_path,
+                [table.reductions for table in tables],
+                self.chunksize,
+                self.seed,
+                barcode_counts,
+                metrics,
+                profile,
+            )
+            fan_out(
+                rows,
+                [
+                    writer(result, table_dir)
+                    for result, table_dir in zip(results, out_dirs)
+                ],
+            )
+
+        barcode_counts = (
+            tables[0].barcode_counts if self.trust_passed_filters else None
+        )
+        clean(barcode_counts)
+        if barcode_counts is not None and not all(
+            table_metrics["exact_counts"] for table_metrics in metrics
+        ):
+            # as in apply, the outputs are redone with counted totals
+            logging.info("Cleaning again with counted barcode totals")
+            clean(None)
+        for result in results:
+            write_metrics(result.metrics_file, result.metrics)
+        profile.write(os.path.join(out_dir, f"{run_id}_profile.json"))
+
+        return results
+
+
+def sweep_deviations(
+    run_id: str,
+    singlecell_path: str,
+    position_path: str,
+    deviations: List[float],
+    out_dir: str = ".",
+    fragments_path: str = None,
+    **kwargs,
+) -> str:
+    """Report the outlier lanes and projected fragment counts of several
+    deviations without reading fragments.tsv, in {run_id}_sweep.csv.
+    With fragments_path, also clean the fragments under every deviations
+    in one shared read, to {out_dir}/deviations_{d}/.  Returns the path
+    of the report.
+    """
+
+    cleaner = Cleaner(**kwargs)
+    tables = cleaner.sweep(singlecell_path, position_path, deviations)
+    os.makedirs(out_dir, exist_ok=True)
+    out_sweep = os.path.join(out_dir, f"{run_id}_sweep.csv")
+    write_sweep(out_sweep, tables, singlecell_total(singlecell_path))
+
+    if fragments_path is not None:
+        cleaner.apply_many(run_id, tables, fragments_path, out_dir)
+
+    return out_sweep
+
+
+def apply_reductions(
+    run_id: str,
+    reductions_path: str,
+    fragments_path: str,
+    out_dir: str = ".",
+    **kwargs,
+) -> Tuple[str, str]:
+    """Clean fragments with the reduction table artifact of an earlier
+    run; returns the paths of the cleaned fragments file and the metrics
+    csv.
+    """
+
+    table = ReductionTable.read(reductions_path)
+    kwargs.setdefault("decay", table.decay)
+    result = Cleaner(table.deviations, table.degree, **kwargs).apply(
+        run_id, table, fragments_path, out_dir
+    )
+    return result.fragments_file, result.metrics_file
+
+
+def update_reductions(
+    run_id: str,
+    reductions_path: str,
+    previous_dir: str,
+    out_dir: str,
+    fragments_path: str = None,
+    **kwargs,
+) -> Tuple[str, str]:
+    """Update the cleaned output of an earlier run in previous_dir to a
+    new reduction table artifact, rewriting only the changed blocks (see
+    Cleaner.update); returns the paths of the cleaned fragments file and
+    the metrics csv in out_dir.
+    """
+
+    table = ReductionTable.read(reductions_path)
+    kwargs.setdefault("decay", table.decay)
+    result = Cleaner(table.deviations, table.degree, **kwargs).update(
+        run_id, table, previous_dir, fragments_path, out_dir
+    )
+    return result.fragments_file, result.metrics_file
+
+
+def clean_sample(
+    run_id: str,
+    singlecell_path: str,
+    position_path: str,
+    fragments_path: str,
+    deviations: float,
+    out_dir: str = ".",
+    **kwargs,
+) -> Tuple[str, str]:
+    """Clean one sample with a Cleaner built from deviations and kwargs;
+    returns the paths of the cleaned fragments file and the metrics csv.
+    """
+
+    result = Cleaner(deviations, **kwargs).clean(
+        run_id, singlecell_path, position_path, fragments_path, out_dir
+    )
+    return result.fragments_file, result.metrics_file
+
+
+if __name__ == "__main__" and sys.argv[1] == "apply":
+    # clean.py apply run_id reductions.json fragments [chunksize] [seed]
+    run_id, reductions_path, fragments_path = sys.argv[2:5]
+    chunksize = int(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_CHUNKSIZE
+    seed = int(sys.argv[6]) if len(sys.argv) > 6 else None
+
+    apply_reductions(
+        run_id, reductions_path, fragments_path, chunksize=chunksize, seed=seed
+    )
+
+elif __name__ == "__main__" and sys.argv[1] == "update":
+    # clean.py update run_id reductions.json previous_dir out_dir
+    #   [fragments] [seed]
+    run_id, reductions_path, previous_dir, out_dir = sys.argv[2:6]
+    fragments_path = sys.argv[6] if len(sys.argv) > 6 else None
+    seed = int(sys.argv[7]) if len(sys.argv) > 7 else None
+
+    update_reductions(
+        run_id,
+        reductions_path,
+        previous_dir,
+        out_dir,
+        fragments_path,
+        seed=seed,
+    )
+
+elif __name__ == "__main__" and sys.argv[1] == "sweep":
+    # clean.py sweep run_id singlecell positions 1,1.5,2 [fragments]
+    run_id, singlecell_path, position_path = sys.argv[2:5]
+    deviations = [float(d) for d in sys.argv[5].split(",")]
+    fragments_path = sys.argv[6] if len(sys.argv) > 6 else None
+
+    sweep_deviations(
+        run_id,
+        singlecell_path,
+        position_path,
+        deviations,
+        fragments_path=fragments_path,
+    )
+
+elif __name__ == "__main__":
     run_id = sys.argv[1]
-    metrics_output["run_id"] = run_id
     singlecell_path = sys.argv[2]
     position_path = sys.argv[3]
     fragments_path = sys.argv[4]
-    deviations = int(sys.argv[5])
-    degree = 1
-
-    singlecell = filter_sc(singlecell_path, position_path)
-    reduct_dict = combine_tables(singlecell, deviations, degree)
-    cleaned = clean_fragments(fragments_path, reduct_dict)
-
-    cleaned.to_csv(f"{run_id}_fragments.tsv", sep="\t", index=False, header=False)
-
-    fields = [
-        "Run_Id",
-        "Rows downsampled",
-        "Columns downsampled",
-        "Diagonal downsampled",
-        "Original fragments",
-        "Final fragments",
-        "pct_diff",
-    ]
-    filename = f"{run_id}_cleaning_metrics.csv"
-    with open(filename, "w") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(fields)
-        writer.writerow(list(metrics_output.values()))
+    deviations = float(sys.argv[5])
+    chunksize = int(sys.argv[6]) if len(sys.argv) > 6 else DEFAULT_CHUNKSIZE
+    seed = int(sys.argv[7]) if len(sys.argv) > 7 else None
+    degree = int(sys.argv[8]) if len(sys.argv) > 8 else 1
+
+    clean_sample(
+        run_id,
+        singlecell_path,
+        position_path,
+        fragments_path,
+        deviations,
+        degree=degree,
+        chunksize=chunksize,
+        seed=seed,
+    )
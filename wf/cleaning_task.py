@@ -1,10 +1,11 @@
 import logging
-import subprocess
 
-from latch import large_task
 from latch.types import LatchDir, LatchFile
 
 from dataclasses import dataclass
+from typing import Optional
+
+from wf.cache import LatchCache, cache_key
 
 logging.basicConfig(
     format="%(levelname)s - %(asctime)s - %(message)s", level=logging.INFO
@@ -18,7 +19,9 @@ class Sample:
     positions_file: LatchFile
     fragments_file: LatchFile
     output_dir: str
-    deviations: int
+    deviations: float
+    degree: int = 1
+    parquet: bool = False
 
 
 @dataclass
@@ -26,58 +29,70 @@ class CleaningOutput:
     run_id: str
     cleaned_fragment_dir: LatchDir
     positions_file: LatchFile
+    parquet_file: Optional[LatchFile] = None
 
 
-@large_task
-def cleaning_task(sample: Sample) -> CleaningOutput:
-    _r_cmd = [
-        "python",
-        "/root/wf/clean.py",
-        sample.run_id,
-        sample.singlecell_file.local_path,
-        sample.positions_file.local_path,
-        sample.fragments_file.local_path,
-        str(sample.deviations),
-    ]
-
-    logging.info("cleaning...")
-    subprocess.run(_r_cmd)
-
-    out_table = f"{sample.run_id}_fragments.tsv"
-    out_metrics = f"{sample.run_id}_cleaning_metrics.csv"
+def local_output_dir(sample: Sample) -> str:
+    return f"/root/{sample.output_dir}"
 
-    _sort_cmd = ["sort", "-k1,1V", "-k2,2n", out_table]
 
-    logging.info("sorting...")
-    subprocess.run(_sort_cmd, stdout=open(f"cleaned_{out_table}", "w"))
+def remote_output_dir(sample: Sample) -> str:
+    return f"latch:///cleaned/{sample.output_dir}"
 
-    _zip_cmd = ["bgzip", f"cleaned_{out_table}"]
 
-    logging.info("zipping...")
-    subprocess.run(_zip_cmd)
-    out_file = f"cleaned_{out_table}.gz"
+def parquet_file(sample: Sample, remote_dir: str) -> Optional[LatchFile]:
+    """The Parquet copy of the cleaned fragments in remote_dir, if the
+    sample asked for one.
+    """
 
-    subprocess.run(["mkdir", sample.output_dir])
-    subprocess.run(["mv", out_file, out_metrics, sample.output_dir])
+    if not sample.parquet:
+        return None
+    return LatchFile(
+        f"{remote_dir}/cleaned_{sample.run_id}_fragments.parquet"
+    )
 
-    local_dir = f"/root/{sample.output_dir}"
-    remote_dir = f"latch:///cleaned/{sample.output_dir}"
 
+def cleaning_output(sample: Sample) -> CleaningOutput:
     return CleaningOutput(
         run_id=sample.run_id,
-        cleaned_fragment_dir=LatchDir(local_dir, remote_dir),
-        positions_file=sample.positions_file
+        cleaned_fragment_dir=LatchDir(
+            local_output_dir(sample), remote_output_dir(sample)
+        ),
+        positions_file=sample.positions_file,
+        parquet_file=parquet_file(sample, remote_output_dir(sample)),
+    )
+
+
+def sample_cache_key(sample: Sample) -> str:
+    return cache_key(
+        sample.run_id,
+        sample.singlecell_file.local_path,
+        sample.positions_file.local_path,
+        sample.fragments_file.local_path,
+        sample.deviations,
+        sample.degree,
+        parquet=sample.parquet,
     )
 
 
-if __name__ == "__main__":
-    cleaning_task(
-        sample=Sample(
-            run_id="ds_D01033_NG01681",
-            output_dir="hannah_ds_D01033_NG01681",
-            singlecell_file = LatchFile("latch://13502.account/atac_outs/ds_D01033_NG01681/outs/ds_D01033_NG01681_singlecell.csv"),
-            positions_file = LatchFile("latch://13502.account/spatials/demo/spatial/tissue_positions_list.csv"),
-            fragments_file = LatchFile("latch://13502.account/atac_outs/ds_D01033_NG01681/outs/ds_D01033_NG01681_fragments.tsv.gz"),
-            deviations=1, 
-        )
+def cached_output(sample: Sample, key: str) -> Optional[CleaningOutput]:
+    """CleaningOutput of an earlier run with the same inputs, parameters
+    and code, copied from the cache to the sample's output directory, if
+    there is one.
+    """
+
+    cache = LatchCache()
+    if cache.get(key) is None:
+        return None
+    if not cache.restore(key, remote_output_dir(sample)):
+        return None
+
+    logging.info(f"{sample.run_id}: reusing outputs in {cache.path(key)}")
+    remote_dir = remote_output_dir(sample)
+    return CleaningOutput(
+        run_id=sample.run_id,
+        cleaned_fragment_dir=LatchDir(remote_dir),
+        positions_file=sample.positions_file,
+        parquet_file=parquet_file(sample, remote_dir),
     )
+
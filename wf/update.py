@@ -0,0 +1,624 @@
+"""In-place update of a cleaned fragments file to a new reduction table:
+only the BGZF blocks holding fragments of barcodes whose count changes
+are rewritten, and the tabix and barcode indexes are patched.
+"""
+
+import collections
+import logging
+import math
+import numpy as np
+import os
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+if __package__:
+    from .bgzf import (
+        BGZF_BLOCK_SIZE,
+        BGZF_EOF,
+        BgzfReader,
+        TabixIndex,
+        TabixReference,
+        bgzf_block,
+        line_starts,
+        read_barcode_index,
+        write_barcode_index,
+    )
+    from .clean import (
+        DEFAULT_CHUNKSIZE,
+        FRAGMENT_COLUMNS,
+        FRAGMENT_DTYPES,
+        StageProfile,
+        barcode_lookup,
+        parse_fragments,
+        read_fragments,
+    )
+else:
+    from bgzf import (
+        BGZF_BLOCK_SIZE,
+        BGZF_EOF,
+        BgzfReader,
+        TabixIndex,
+        TabixReference,
+        bgzf_block,
+        line_starts,
+        read_barcode_index,
+        write_barcode_index,
+    )
+    from clean import (
+        DEFAULT_CHUNKSIZE,
+        FRAGMENT_COLUMNS,
+        FRAGMENT_DTYPES,
+        StageProfile,
+        barcode_lookup,
+        parse_fragments,
+        read_fragments,
+    )
+
+
+def parse_lines(data: bytes, base: int) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Parse whole fragment lines written at uncompressed offset base;
+    returns them with the offset of every line.
+    """
+
+    if not data:
+        empty = pd.DataFrame(
+            {c: pd.Series(dtype=FRAGMENT_DTYPES[c]) for c in FRAGMENT_COLUMNS}
+        )
+        return empty, np.zeros(0, dtype=np.int64)
+    return parse_fragments(data), line_starts(data, base)
+
+
+def line_keys(fragments: pd.DataFrame, ranks: Dict[str, int]) -> np.ndarray:
+    """Sort key of fragments in a file whose chromosomes come in the
+    order of ranks: chromosome rank in the high bits, start in the low.
+    """
+
+    chroms = fragments["V1"].astype(str).map(ranks).to_numpy(dtype=np.int64)
+    return chroms << 32 | fragments["V2"].to_numpy(dtype=np.int64)
+
+
+def changed_barcodes(
+    kept: Dict[str, int],
+    old_table: Dict[str, float],
+    new_table: Dict[str, float],
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Compare the fragment counts kept under old_table with the targets
+    of new_table.  Returns the barcodes to lower, with their new count,
+    and the barcodes to raise, with their new target (-1 for all their
+    fragments).  Barcodes kept whole under old_table can only be
+    lowered.
+    """
+
+    lower = {}
+    raise_ = {}
+    for barcode in sorted(set(old_table) | set(new_table)):
+        count = kept.get(barcode, 0)
+        whole = (
+            barcode not in old_table
+            or count < math.floor(old_table[barcode])
+        )
+        target = (
+            math.floor(new_table[barcode]) if barcode in new_table else None
+        )
+        if target is not None and target < count:
+            lower[barcode] = target
+        elif not whole and (target is None or target > count):
+            raise_[barcode] = -1 if target is None else target
+
+    return lower, raise_
+
+
+def merge_lines(
+    lines: List[bytes],
+    keys: np.ndarray,
+    inserts: List[bytes],
+    insert_keys: np.ndarray,
+) -> bytes:
+    """Insert sorted lines into sorted lines, after the lines with equal
+    sort keys.
+    """
+
+    slots = np.concatenate(
+        [
+            2 * np.arange(len(lines)) + 1,
+            2 * np.searchsorted(keys, insert_keys, side="right"),
+        ]
+    )
+    pieces = lines + inserts
+    return b"".join(pieces[x] for x in np.argsort(slots, kind="stable"))
+
+
+def update_tabix(
+    index: TabixIndex,
+    fresh: TabixIndex,
+    spans: List[Tuple[int, int, int, int]],
+    removed: Dict[str, int],
+) -> TabixIndex:
+    """Index of a file with spans of lines rewritten, from the index of
+    the old file and fresh, the index of the new lines.  spans are the
+    (old start, old end, new start, new end) offsets of the rewritten
+    lines, in order; removed counts the old lines of each chromosome in
+    them.  Offsets outside of spans shift with the spans before them;
+    offsets inside a span map to its new start.
+    """
+
+    old_starts = np.array([span[0] for span in spans], dtype=np.int64)
+    old_ends = np.array([span[1] for span in spans], dtype=np.int64)
+    new_starts = np.array([span[2] for span in spans], dtype=np.int64)
+    shifts = np.zeros(len(spans) + 1, dtype=np.int64)
+    shifts[1:] = [span[3] - span[1] for span in spans]
+
+    def remap(offsets: np.ndarray) -> np.ndarray:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        after = np.searchsorted(old_ends, offsets, side="right")
+        mapped = offsets + shifts[after]
+        inside = after < len(spans)
+        inside[inside] = offsets[inside] > old_starts[after[inside]]
+        mapped[inside] = new_starts[after[inside]]
+        return mapped
+
+    updated = TabixIndex()
+    for name, ref in index.refs.items():
+        target = updated.refs.setdefault(name, TabixReference())
+        bins = list(ref.bins)
+        chunks = np.array(
+            [chunk for b in bins for chunk in ref.bins[b]], dtype=np.int64
+        ).reshape(-1, 2)
+        chunk_bins = np.repeat(bins, [len(ref.bins[b]) for b in bins])
+
+        # Keep the parts of each chunk outside of the spans
+        first = np.searchsorted(old_ends, chunks[:, 0], side="right")
+        last = np.searchsorted(old_starts, chunks[:, 1], side="left")
+        clipped = first < last
+        pieces = [chunks[~clipped]]
+        piece_bins = [chunk_bins[~clipped]]
+        for x in np.flatnonzero(clipped).tolist():
+            u_start, u_end = chunks[x].tolist()
+            for s in range(first[x], last[x]):
+                if u_start < old_starts[s]:
+                    pieces.append([[u_start, old_starts[s]]])
+                    piece_bins.append([chunk_bins[x]])
+                u_start = max(u_start, int(old_ends[s]))
+            if u_start < u_end:
+                pieces.append([[u_start, u_end]])
+                piece_bins.append([chunk_bins[x]])
+        pieces = remap(np.concatenate(pieces)).reshape(-1, 2)
+        piece_bins = np.concatenate(piece_bins)
+        order = np.lexsort((pieces[:, 0], piece_bins))
+        pieces = pieces[order]
+        piece_bins = piece_bins[order]
+        bounds = np.flatnonzero(np.diff(piece_bins)) + 1
+        starts = np.r_[0, bounds].tolist()
+        ends = np.r_[bounds, len(pieces)].tolist()
+        pieces = pieces.tolist()
+        if pieces:
+            target.bins = {
+                b: pieces[start:end]
+                for b, start, end in zip(
+                    piece_bins[starts].tolist(), starts, ends
+                )
+            }
+
+        target.linear = dict(
+            zip(ref.linear, remap(list(ref.linear.values())).tolist())
+        )
+        target.first, target.last = remap([ref.first, ref.last]).tolist()
+        target.n_records = ref.n_records - removed.get(name, 0)
+
+    for name, ref in fresh.refs.items():
+        target = updated.refs.setdefault(name, TabixReference())
+        for b, chunks in ref.bins.items():
+            target.bins[b] = sorted(target.bins.get(b, []) + chunks)
+        for w, u_start in ref.linear.items():
+            target.linear[w] = min(target.linear.get(w, u_start), u_start)
+        target.first = min(target.first, ref.first)
+        target.last = max(target.last, ref.last)
+        target.n_records += ref.n_records
+
+    for name in [n for n, ref in updated.refs.items() if ref.n_records == 0]:
+        del updated.refs[name]
+    return updated
+
+
+def sample_originals(
+    fragments_path: str,
+    needed: Dict[str, float],
+    kept_lines: collections.Counter,
+    chunksize: int,
+    rng: np.random.Generator,
+) -> List[bytes]:
+    """Uniform sample of the lines of fragments_path not in kept_lines,
+    needed[barcode] of each barcode (or all of them if fewer), in one
+    streaming pass.  Each barcode keeps the lines with the smallest random
+    keys seen so far, so memory holds a chunk and the sampled lines.
+    """
+
+    wanted = pd.Index(list(needed))
+    limits = pd.Series(needed, dtype=float)
+    seen = collections.Counter()
+    sample = pd.DataFrame(
+        {
+            "barcode": pd.Series(dtype=object),
+            "line": pd.Series(dtype=object),
+            "key": pd.Series(dtype=float),
+        }
+    )
+    for chunk in read_fragments(fragments_path, chunksize):
+        found = chunk[barcode_lookup(chunk["barcodes"], wanted) >= 0]
+        if found.shape[0] == 0:
+            continue
+        text = found.to_csv(sep="\t", index=False, header=False)
+        lines = pd.Series(text.encode().splitlines(keepends=True))
+
+        # The first kept_lines[line] copies of a line are the kept ones
+        limit = lines.map(lambda line: kept_lines.get(line, 0))
+        known = lines[limit > 0]
+        before = known.map(lambda line: seen.get(line, 0))
+        is_kept = pd.Series(False, index=lines.index)
+        is_kept[known.index] = (
+            before + known.groupby(known).cumcount() < limit[known.index]
+        )
+        seen.update(known.tolist())
+
+        candidates = pd.DataFrame(
+            {
+                "barcode": found["barcodes"].astype(str).to_numpy()[~is_kept],
+                "line": lines[~is_kept].to_numpy(),
+                "key": rng.random(int((~is_kept).sum())),
+            }
+        )
+        sample = pd.concat([sample, candidates], ignore_index=True)
+        sample = sample.sort_values("key", kind="stable")
+        rank = sample.groupby("barcode").cumcount().to_numpy()
+        sample = sample[rank < limits[sample["barcode"]].to_numpy()]
+
+    return sample["line"].tolist()
+
+
+def update_fragments(
+    previous_path: str,
+    old_table: Dict[str, float],
+    new_table: Dict[str, float],
+    out_path: str,
+    fragments_path: str = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    seed: int = None,
+    profile: StageProfile = None,
+) -> Dict[str, int]:
+    """Re-clean a cleaned fragments file written with reduction table
+    old_table to new_table, rewriting only the BGZF blocks that hold
+    fragments of barcodes whose count changes and copying every other
+    block as stored.  The barcode index of the previous file (.bci,
+    BarcodeBlockIndex) gives the kept count of each barcode and the
+    regions of blocks holding its fragments.
+
+    Lowered barcodes drop a uniform sample of their kept fragments.
+    Raised barcodes (downsampled under old_table, with a higher or no
+    target in new_table) gain a uniform sample of their fragments not
+    kept, streamed from the original fragments_path (sample_originals).
+    Either way the kept fragments stay a uniform sample of the original
+    ones.  Writes out_path with its tabix and barcode indexes; returns the
+    numbers of fragments dropped and added and of blocks rewritten, or
+    None if a fragment to add is on a chromosome missing from the
+    previous file.
+    """
+
+    if profile is None:
+        profile = StageProfile()
+    rng = np.random.default_rng(seed)
+
+    with profile.stage("select") as stage_counts:
+        index = read_barcode_index(f"{previous_path}.bci")
+        blocks = index["blocks"]
+        u_starts = blocks[:, 0]
+        n_blocks = len(blocks) - 1
+        region_blocks = index["region_blocks"]
+        regions = np.repeat(
+            np.arange(len(region_blocks) - 1), np.diff(index["indptr"])
+        )
+        codes = index["codes"]
+        counts = index["counts"]
+        barcodes = index["barcodes"].tolist()
+        chroms = index["chroms"].tolist()
+        first = index["first"]
+        code_of = {barcode: i for i, barcode in enumerate(barcodes)}
+        ranks = {chrom: i for i, chrom in enumerate(chroms)}
+
+        # Entries of each barcode; kept fragments of each barcode
+        by_code = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[by_code], np.arange(len(barcodes) + 1))
+        kept = np.bincount(codes, weights=counts, minlength=len(barcodes))
+        kept = kept.astype(np.int64)
+        lower, raise_ = changed_barcodes(
+            dict(zip(barcodes, kept.tolist())), old_table, new_table
+        )
+        if raise_ and fragments_path is None:
+            raise ValueError(
+                "Raising the target of barcodes needs the original "
+                "fragments file."
+            )
+        logging.info(
+            f"{len(lower)} barcodes to lower, {len(raise_)} to raise"
+        )
+
+        # Split the fragments each lowered barcode drops across regions,
+        # and find the regions holding fragments of raised barcodes
+        drops = collections.defaultdict(dict)
+        scans = collections.defaultdict(list)
+        for barcode, target in lower.items():
+            code = code_of[barcode]
+            rows = by_code[bounds[code] : bounds[code + 1]]
+            split = rng.multivariate_hypergeometric(
+                counts[rows], kept[code] - target
+            )
+            for region, n in zip(regions[rows].tolist(), split.tolist()):
+                if n > 0:
+                    drops[region][barcode] = n
+        for barcode in raise_:
+            if barcode in code_of:
+                code = code_of[barcode]
+                rows = by_code[bounds[code] : bounds[code + 1]]
+                for region in regions[rows].tolist():
+                    scans[region].append(barcode)
+
+        # Pick the dropped lines and collect the kept lines of raised
+        # barcodes, region by region
+        reader = BgzfReader(previous_path, blocks)
+        dropped_at = [np.zeros(0, dtype=np.int64)]
+        kept_lines = collections.Counter()
+        for region in sorted(set(drops) | set(scans)):
+            start = reader.line_start(int(u_starts[region_blocks[region]]))
+            end = reader.line_start(int(u_starts[region_blocks[region + 1]]))
+            data = reader.read(start, end)
+            reader.clear()
+            fragments, offsets = parse_lines(data, start)
+            stage_counts["rows"] += fragments.shape[0]
+            stage_counts["bytes"] += len(data)
+            region_barcodes = fragments["barcodes"].astype(str).to_numpy()
+            for barcode, n in drops.get(region, {}).items():
+                rows = np.flatnonzero(region_barcodes == barcode)
+                dropped_at.append(offsets[rng.choice(rows, n, replace=False)])
+            if region in scans:
+                lines = data.splitlines(keepends=True)
+                for barcode in scans[region]:
+                    kept_lines.update(
+                        lines[i]
+                        for i in np.flatnonzero(region_barcodes == barcode)
+                    )
+        dropped_at = np.sort(np.concatenate(dropped_at))
+
+        # Lines added to raised barcodes, sorted, and the block each
+        # goes to: the last one whose first line sorts at or before it
+        inserts = []
+        if raise_:
+            needed = {}
+            for barcode, target in raise_.items():
+                count = kept[code_of[barcode]] if barcode in code_of else 0
+                needed[barcode] = np.inf if target < 0 else target - count
+            inserts = sample_originals(
+                fragments_path, needed, kept_lines, chunksize, rng
+            )
+        added, _ = parse_lines(b"".join(inserts), 0)
+        if not added["V1"].astype(str).isin(ranks).all():
+            reader.close()
+            return None
+        insert_keys = line_keys(added, ranks)
+        order = np.argsort(insert_keys, kind="stable")
+        insert_keys = insert_keys[order]
+        inserts = [inserts[i] for i in order]
+        starting = np.flatnonzero(first[:, 0] >= 0)
+        first_keys = first[starting, 0] << 32 | first[starting, 1]
+        at = np.searchsorted(first_keys, insert_keys, side="right") - 1
+        insert_blocks = starting[np.maximum(at, 0)]
+
+        # Runs of affected blocks [i, j]; a run rewrites blocks i..k - 1,
+        # up to the block where the last line of block j ends
+        affected = np.union1d(reader.block_of(dropped_at), insert_blocks)
+        runs = []
+        for b in affected.tolist():
+            if runs and b <= runs[-1][2]:
+                runs[-1][1] = b
+            else:
+                runs.append([b, b, b + 1])
+            end = reader.line_start(int(u_starts[b + 1]))
+            runs[-1][2] = int(np.searchsorted(u_starts, end, side="left"))
+
+    with profile.stage("rewrite") as stage_counts:
+        fresh = TabixIndex()
+        spans = []
+        removed = collections.Counter()
+        entries = [(regions, codes, counts)]
+        new_blocks = []
+        new_first = []
+        moved = []  # (i, k, new i, new k) of each run
+        u_shift = 0
+        copied = 0
+        with open(out_path, "wb") as out, ThreadPoolExecutor(
+            os.cpu_count() or 1
+        ) as executor:
+
+            def copy(first_block: int, last_block: int):
+                c_shift = out.tell() - int(blocks[first_block, 1])
+                new_blocks.extend(
+                    zip(
+                        (u_starts[first_block:last_block] + u_shift).tolist(),
+                        (blocks[first_block:last_block, 1] + c_shift).tolist(),
+                    )
+                )
+                new_first.append(first[first_block:last_block])
+                reader.copy(first_block, last_block, out)
+
+            def region_of(block: np.ndarray) -> np.ndarray:
+                return np.searchsorted(region_blocks, block, side="right") - 1
+
+            def region_entries(fragments: pd.DataFrame, region, sign: int):
+                region_codes = np.array(
+                    [
+                        code_of.setdefault(b, len(code_of))
+                        for b in fragments["barcodes"].astype(str)
+                    ],
+                    dtype=np.int64,
+                )
+                entries.append(
+                    (
+                        np.broadcast_to(region, len(region_codes)),
+                        region_codes,
+                        np.full(len(region_codes), sign, dtype=np.int64),
+                    )
+                )
+
+            for i, j, k in runs:
+                copy(copied, i)
+                body_start = reader.line_start(int(u_starts[i]))
+                body_end = reader.line_start(int(u_starts[j + 1]))
+                tail_end = reader.line_start(int(u_starts[k]))
+                head = reader.read(int(u_starts[i]), body_start)
+                body = reader.read(body_start, body_end)
+                tail = reader.read(body_end, int(u_starts[k]))
+                old, offsets = parse_lines(body, body_start)
+                tail_fragments, tail_offsets = parse_lines(
+                    reader.read(body_end, tail_end), body_end
+                )
+                reader.clear()
+
+                keep = ~np.isin(offsets, dropped_at)
+                in_run = np.flatnonzero(
+                    (insert_blocks >= i) & (insert_blocks <= j)
+                )
+                new_body = merge_lines(
+                    [
+                        line
+                        for line, kept in zip(
+                            body.splitlines(keepends=True), keep
+                        )
+                        if kept
+                    ],
+                    line_keys(old, ranks)[keep],
+                    [inserts[x] for x in in_run],
+                    insert_keys[in_run],
+                )
+
+                new_i = len(new_blocks)
+                u_run = int(u_starts[i]) + u_shift
+                content = head + new_body + tail
+                for x, block in enumerate(
+                    executor.map(
+                        bgzf_block,
+                        [
+                            content[x : x + BGZF_BLOCK_SIZE]
+                            for x in range(0, len(content), BGZF_BLOCK_SIZE)
+                        ],
+                    )
+                ):
+                    u_block = u_run + x * BGZF_BLOCK_SIZE
+                    new_blocks.append((u_block, out.tell()))
+                    out.write(block)
+                moved.append((i, k, new_i, len(new_blocks)))
+
+                # Indexes: the new lines and the lines of the tail now start
+                # in the run's new blocks, which join the region of block i
+                body_new_start = u_run + len(head)
+                new, new_offsets = parse_lines(new_body, body_new_start)
+                if new.shape[0]:
+                    fresh.add(
+                        new["V1"].to_numpy(),
+                        new["V2"].to_numpy(),
+                        new["V3"].to_numpy(),
+                        body_new_start,
+                        new_body,
+                    )
+                spans.append(
+                    (
+                        body_start,
+                        body_end,
+                        body_new_start,
+                        body_new_start + len(new_body),
+                    )
+                )
+                removed.update(old["V1"].astype(str).tolist())
+                u_shift += len(new_body) - len(body)
+
+                for fragments, line_offsets in [
+                    (old, offsets),
+                    (tail_fragments, tail_offsets),
+                ]:
+                    region_entries(
+                        fragments, region_of(reader.block_of(line_offsets)), -1
+                    )
+                after = pd.concat([new, tail_fragments], ignore_index=True)
+                region_entries(after, region_of(i), 1)
+
+                run_first = np.full((len(new_blocks) - new_i, 2), -1)
+                line_offsets = np.concatenate(
+                    [new_offsets, tail_offsets + u_shift]
+                )
+                local, rows = np.unique(
+                    (line_offsets - u_run) // BGZF_BLOCK_SIZE,
+                    return_index=True,
+                )
+                run_first[local, 0] = (
+                    after["V1"].astype(str).map(ranks).to_numpy()[rows]
+                )
+                run_first[local, 1] = after["V2"].to_numpy()[rows]
+                new_first.append(run_first)
+                stage_counts["rows"] += new.shape[0]
+                stage_counts["bytes"] += len(content)
+                copied = k
+
+            copy(copied, n_blocks)
+            new_blocks.append((int(u_starts[-1]) + u_shift, out.tell()))
+            out.write(BGZF_EOF)
+        reader.close()
+
+        old_index = TabixIndex.read(
+            f"{previous_path}.tbi", [tuple(b) for b in blocks.tolist()]
+        )
+        update_tabix(old_index, fresh, spans, removed).write(
+            f"{out_path}.tbi", new_blocks
+        )
+
+        # Regions keep their first block, moved past the runs before it
+        run_starts = np.array([run[0] for run in moved], dtype=np.int64)
+
+        def new_block(b: int) -> int:
+            r = int(np.searchsorted(run_starts, b, side="right")) - 1
+            if r < 0:
+                return b
+            i, k, new_i, new_k = moved[r]
+            if b == i:
+                return new_i
+            return new_k + max(b - k, 0)
+
+        entry_regions, entry_codes, entry_counts = map(
+            np.concatenate, zip(*entries)
+        )
+        keys, inverse = np.unique(
+            entry_regions.astype(np.int64) << 32 | entry_codes,
+            return_inverse=True,
+        )
+        totals = np.bincount(inverse, weights=entry_counts).astype(np.int64)
+        write_barcode_index(
+            f"{out_path}.bci",
+            new_blocks,
+            [new_block(b) for b in region_blocks.tolist()],
+            keys[totals > 0] >> 32,
+            keys[totals > 0] & 0xFFFFFFFF,
+            totals[totals > 0],
+            list(code_of),
+            chroms,
+            np.concatenate(new_first).reshape(-1, 2),
+        )
+
+    rewritten = sum(k - i for i, k, _, _ in moved)
+    logging.info(
+        f"Rewrote {rewritten} of {n_blocks} blocks: {len(dropped_at)} "
+        f"fragments dropped, {len(inserts)} added"
+    )
+    return {
+        "dropped": len(dropped_at),
+        "added": len(inserts),
+        "rewritten": rewritten,
+    }
+
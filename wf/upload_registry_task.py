@@ -9,6 +9,8 @@ from typing import List
 
 logging.basicConfig(format="%(levelname)s - %(asctime)s - %(message)s")
 
+PARQUET_COLUMN = "cleaned_parquet_file"
+
 
 @small_task(retries=0)
 def upload_registry_task(
@@ -16,15 +18,27 @@ def upload_registry_task(
 ):
     table = Table(table_id)
     try:
+        # Parquet outputs are only registered in tables with a column for
+        # them, so that the other fields are still upserted
+        has_parquet = PARQUET_COLUMN in table.get_columns()
+        if not has_parquet and any(
+            c.parquet_file is not None for c in cleaned_outputs
+        ):
+            logging.warning(
+                f"Table {table_id} has no {PARQUET_COLUMN} column; "
+                "Parquet outputs are not registered."
+            )
         with table.update() as updater:
             for c in cleaned_outputs:
-                updater.upsert_record(
-                    c.run_id,
-                    cleaned_fragment_file=LatchFile(
+                values = {
+                    "cleaned_fragment_file": LatchFile(
                         f"{c.cleaned_fragment_dir.remote_path}/cleaned_{c.run_id}_fragments.tsv.gz"
                     ),
-                    positions_file=c.positions_file
-                )
+                    "positions_file": c.positions_file,
+                }
+                if has_parquet and c.parquet_file is not None:
+                    values[PARQUET_COLUMN] = c.parquet_file
+                updater.upsert_record(c.run_id, **values)
     except TypeError:
         print("error")
         logging.warning(f"No table with id {table_id} found.")